@@ -1,10 +1,36 @@
+from .addresses import AddressAllocator
+
+from .config import aggregate_allowed_ips
+from .config import clear_section_cache
 from .config import delete_config
+from .config import get_section_cache_stats
+from .config import render_nftables_ruleset
+from .config import render_peer
+from .config import render_site
+from .config import strip_wg_quick
 from .config import write_config
+from .config import write_configs
+from .config import ConfigWriteResult
+from .config import SectionCacheStats
+from .config import SiteWriteResult
+
+from .diff import diff_config
+from .diff import diff_configs
+from .diff import CONFIG_DIFF_STATUS
+from .diff import ConfigDiff
+
+from .firewall import get_nftables_ruleset
+from .firewall import FirewallNetworks
 
 from .helpers import convert_list_to_str
 from .helpers import convert_str_to_list
 from .helpers import get_default_dns
 
+from .index import KEY_INDEX_MESSAGE_TYPE
+from .index import KeyIndex
+from .index import KeyIndexMessage
+from .index import KeyIndexMessageContent
+
 from .integrity import check_additional_allowed_ips
 from .integrity import check_dns
 from .integrity import check_endpoint
@@ -12,7 +38,7 @@ from .integrity import check_imported_settings
 from .integrity import check_imported_sites
 from .integrity import check_ip_networks
 from .integrity import check_port
-from .integrity import check_wireguard
+from .integrity import check_psk
 from .integrity import AAIPs_MESSAGE_TYPE
 from .integrity import DNS_MESSAGE_TYPE
 from .integrity import ENDPOINT_MESSAGE_TYPE
@@ -20,6 +46,7 @@ from .integrity import IP_NETWORK_MESSAGE_TYPE
 from .integrity import KEY_DATATYPE_MESSAGE_TYPE
 from .integrity import KEY_PRESENCE_MESSAGE_TYPE
 from .integrity import PORT_MESSAGE_TYPE
+from .integrity import PSK_MESSAGE_TYPE
 from .integrity import AAIPsMessageContent
 from .integrity import AAIPsMessage
 from .integrity import DNSMessage
@@ -34,12 +61,23 @@ from .integrity import KeyPresenceMessage
 from .integrity import KeyPresenceMessageContent
 from .integrity import PortMessage
 from .integrity import PortMessageContent
+from .integrity import PskMessage
+from .integrity import PskMessageContent
 
 from .io_ import read_file
 from .io_ import write_file
 
+from .keys import get_key_pool_stats
+from .keys import check_wireguard
 from .keys import get_keys
+from .keys import get_keys_async
+from .keys import get_psk
+from .keys import get_pubkey
+from .keys import is_valid_key
+from .keys import KeyPoolStats
+from .keys import PSK_MODES
 
+from .typedefs import AddressPoolExhaustedError
 from .typedefs import CONNECTION_TABLE_MESSAGE_TYPE
 from .typedefs import MESSAGE_LEVEL
 from .typedefs import ConnectionTable
@@ -50,6 +88,7 @@ from .typedefs import JSONDecodeError
 from .typedefs import JsonDict
 from .typedefs import KeyDoesExistError
 from .typedefs import KeyDoesNotExistError
+from .typedefs import KeyIndexError
 from .typedefs import Message
 from .typedefs import MessageContent
 from .typedefs import Keys
@@ -77,29 +116,54 @@ __all__ = [
   "check_dns",
   "check_endpoint",
   "check_imported_settings",
+  "aggregate_allowed_ips",
   "check_imported_sites",
   "check_ip_networks",
   "check_port",
+  "check_psk",
   "check_wireguard",
+  "clear_section_cache",
   "convert_list_to_str",
   "convert_str_to_list",
   "delete_config",
+  "diff_config",
+  "diff_configs",
   "get_default_dns",
+  "get_key_pool_stats",
   "get_keys",
+  "get_keys_async",
+  "get_nftables_ruleset",
+  "get_psk",
+  "get_section_cache_stats",
+  "get_pubkey",
+  "is_valid_key",
   "read_file",
+  "render_nftables_ruleset",
+  "render_peer",
+  "render_site",
+  "strip_wg_quick",
   "write_config",
+  "write_configs",
   "write_file",
   "AAIPs_MESSAGE_TYPE",
+  "CONFIG_DIFF_STATUS",
   "CONNECTION_TABLE_MESSAGE_TYPE",
   "DNS_MESSAGE_TYPE",
   "ENDPOINT_MESSAGE_TYPE",
   "IP_NETWORK_MESSAGE_TYPE",
   "KEY_DATATYPE_MESSAGE_TYPE",
+  "KEY_INDEX_MESSAGE_TYPE",
   "KEY_PRESENCE_MESSAGE_TYPE",
   "MESSAGE_LEVEL",
   "PORT_MESSAGE_TYPE",
+  "PSK_MESSAGE_TYPE",
+  "PSK_MODES",
   "AAIPsMessageContent",
   "AAIPsMessage",
+  "AddressAllocator",
+  "AddressPoolExhaustedError",
+  "ConfigDiff",
+  "ConfigWriteResult",
   "ConnectionTable",
   "ConnectionTableMessage",
   "ConnectionTableMessageContent",
@@ -108,6 +172,7 @@ __all__ = [
   "DNSMessage",
   "EndpointMessageContent",
   "EndpointMessage",
+  "FirewallNetworks",
   "IPNetworkMessage",
   "IPNetworkMessageContent",
   "JSONDecodeError",
@@ -117,8 +182,14 @@ __all__ = [
   "KeyDatatypeMessageContent",
   "KeyDoesExistError",
   "KeyDoesNotExistError",
+  "KeyIndex",
+  "KeyIndexError",
+  "KeyIndexMessage",
+  "KeyIndexMessageContent",
   "KeyPresenceMessage",
   "KeyPresenceMessageContent",
+  "KeyPoolStats",
+  "SectionCacheStats",
   "Message",
   "MessageContent",
   "Peer",
@@ -127,6 +198,8 @@ __all__ = [
   "PeerItems",
   "PortMessage",
   "PortMessageContent",
+  "PskMessage",
+  "PskMessageContent",
   "ReadOnlyJsonDict",
   "RedirectAllTraffic",
   "Result",
@@ -138,6 +211,7 @@ __all__ = [
   "SiteDoesExistError",
   "SiteDoesNotExistError",
   "SiteItems",
+  "SiteWriteResult",
   "WireguardNotFoundError",
   "WireUI",
 ]
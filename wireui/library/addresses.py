@@ -0,0 +1,145 @@
+# addresses.py
+# Persistent allocation of the ip addresses of the peers
+# Author: Tim Schlottmann
+
+import ipaddress
+from typing import Dict
+from typing import List
+
+from .typedefs import AddressPoolExhaustedError
+
+# The allocations of a site are stored in the site as
+# {network: {"next": offset, "free": [offset, ...],
+#            "reserved": [[first offset, last offset], ...],
+#            "peers": {peer name: offset}}}
+# The offsets are relative to the network address. "next" is the first offset
+# that has never been handed out, "free" holds released offsets.
+AddressAllocations = dict
+
+
+class AddressAllocator():
+  """ Stable addresses for the peers of a site
+
+  The allocator works on the allocations stored in the site, so every change
+  is saved together with the site. Addresses are taken from the free list or
+  the next pointer and are released into the free list. """
+  def __init__(self, ip_networks: List[str], allocations: AddressAllocations):
+    self.__networks = [ipaddress.ip_network(n) for n in ip_networks]
+    self.__allocations = allocations
+
+    # Networks that have been removed from the site
+    network_names = [str(n) for n in self.__networks]
+    for n in list(self.__allocations):
+      if n not in network_names:
+        del self.__allocations[n]
+
+    for n in self.__networks:
+      first, _ = self.__get_host_range(n)
+      self.__allocations.setdefault(str(n), {
+        "next": first,
+        "free": [],
+        "reserved": [],
+        "peers": {},
+      })
+
+  def allocate(self, peer_name: str) -> Dict[str, str]:
+    """ Get an address in every network for a peer
+
+    A peer that already has an address keeps it. """
+
+    for n in self.__networks:
+      a = self.__allocations[str(n)]
+      if peer_name in a["peers"]:
+        continue
+
+      if a["free"]:
+        a["peers"][peer_name] = a["free"].pop()
+        continue
+
+      _, last = self.__get_host_range(n)
+      offset = self.__skip_reserved(a, a["next"])
+      if offset > last:
+        raise AddressPoolExhaustedError(str(n))
+      a["peers"][peer_name] = offset
+      a["next"] = offset + 1
+    return self.get_addresses(peer_name)
+
+  def free(self, peer_name: str):
+    """ Release the addresses of a peer """
+
+    for a in self.__allocations.values():
+      if peer_name in a["peers"]:
+        a["free"].append(a["peers"].pop(peer_name))
+
+  def reserve(self, first: str, last: str):
+    """ Exclude a range of addresses from the allocation
+
+    Addresses of the range that are already used by a peer raise a
+    ValueError. """
+
+    first_address = ipaddress.ip_address(first)
+    last_address = ipaddress.ip_address(last)
+    for n in self.__networks:
+      if first_address in n and last_address in n:
+        break
+    else:
+      raise ValueError(f"{first} - {last} is not part of a network of the site")
+
+    a = self.__allocations[str(n)]
+    r = [
+      int(first_address) - int(n.network_address),
+      int(last_address) - int(n.network_address)
+    ]
+    if r[0] > r[1]:
+      raise ValueError(f"{first} is greater than {last}")
+    for p, offset in a["peers"].items():
+      if r[0] <= offset <= r[1]:
+        raise ValueError(
+          f"{n.network_address + offset} is already used by peer {p}")
+
+    a["reserved"].append(r)
+    a["free"] = [o for o in a["free"] if not r[0] <= o <= r[1]]
+
+  def free_unknown(self, peer_names: List[str]):
+    """ Release the addresses of all peers that are not in peer_names """
+
+    peer_names = set(peer_names)
+    for a in self.__allocations.values():
+      for p in [p for p in a["peers"] if p not in peer_names]:
+        a["free"].append(a["peers"].pop(p))
+
+  def get_addresses(self, peer_name: str) -> Dict[str, str]:
+    """ Get the addresses of a peer for every network """
+
+    return {
+      str(n): str(n.network_address +
+                  self.__allocations[str(n)]["peers"][peer_name])
+      for n in self.__networks
+      if peer_name in self.__allocations[str(n)]["peers"]
+    }
+
+  @staticmethod
+  def __skip_reserved(allocation: dict, offset: int) -> int:
+    """ Move an offset behind all reserved ranges it is part of """
+
+    moved = True
+    while moved:
+      moved = False
+      for r in allocation["reserved"]:
+        if r[0] <= offset <= r[1]:
+          offset = r[1] + 1
+          moved = True
+    return offset
+
+  @staticmethod
+  def __get_host_range(network) -> tuple:
+    """ Get the offsets of the first and last host of a network
+
+    The range is the same as the one of network.hosts(). """
+
+    if network.num_addresses <= 2:
+      return 0, network.num_addresses - 1
+    if network.version == 4:
+      return 1, network.num_addresses - 2
+    return 1, network.num_addresses - 1
+
@@ -2,86 +2,903 @@
 # Create and write wireguard config files
 # Author: Tim Schlottmann
 
+import hashlib
 import ipaddress
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import NamedTuple
 from typing import Optional
+from typing import Set
 from typing import Tuple
 
+from .firewall import get_nftables_post_down
+from .firewall import get_nftables_post_up
+from .firewall import get_nftables_ruleset
+from .firewall import FirewallNetworks
+from .keys import is_own_key_peer
+from .keys import LinkPsks
+
 from .typedefs import Keys
 from .typedefs import PeerItems
 from .typedefs import Peers
 from .typedefs import SiteItems
+from .typedefs import Sites
 from .io_ import delete_directory
-from .io_ import prepare_directory
-from .io_ import write_file
+from .io_ import read_archive
+from .io_ import write_archive
+from .io_ import ARCHIVE_FORMATS
+from .io_ import read_file
+from .io_ import remove_file
+from .io_ import stage_directory
+from .io_ import swap_directory
+from .io_ import sync_directory
+from .io_ import write_chunk_streams_if_changed
+from .io_ import write_chunks_if_changed
+from .io_ import write_file_if_changed
+
+# Name of the file that stores the fingerprints of the written config files
+MANIFEST_FILE_NAME = ".wireui_manifest.json"
+
+# Has to be increased whenever the format of the config files changes
+# 2: The link psks include the psks of both peers
+__RENDER_VERSION = 2
+
+# "incremental" updates the files in the site directory one by one, "staged"
+# writes a complete new directory and swaps it in, the archive modes write
+# all files of a site into one archive next to the site directory
+OUTPUT_MODES = ["incremental", "staged", *ARCHIVE_FORMATS]
+
+# The index of an archive is stored next to the archive with this suffix
+ARCHIVE_INDEX_SUFFIX = ".index.json"
+
+# Keys that are only understood by wg-quick and not by wg setconf/syncconf
+WG_QUICK_KEYS = [
+  b"address", b"dns", b"mtu", b"table", b"preup", b"postup", b"predown",
+  b"postdown", b"saveconfig"
+]
+
+
+class ConfigWriteResult(NamedTuple):
+  written: List[str]
+  unchanged: List[str]
+  removed: List[str]
+  # AllowedIPs prefixes saved by the aggregation per peer (empty without it)
+  saved_prefixes: Dict[str, int]
+
+
+class SiteWriteResult(NamedTuple):
+  # None if the site failed
+  result: Optional[ConfigWriteResult]
+  seconds: float
+  error: Optional[Exception]
+
+
+class PeerAdjacency(NamedTuple):
+  # Connected peers in the order of the site
+  neighbors: List[str]
+  ingoing: Set[str]
+  outgoing: Set[str]
+  main_peer: str
+
+
+Adjacency = Dict[str, PeerAdjacency]
+
+
+class PeerAddresses(NamedTuple):
+  # Value of the Address line
+  address: str
+  # Ip versions and addresses (without prefix length) in the order of the
+  # networks of the site
+  versions: Tuple[int, ...]
+  addresses: Tuple[str, ...]
+  # Host routes (/32 or /128) of the addresses
+  host_routes: Tuple[str, ...]
+
+
+# The formatted addresses of the peers, created once per render
+AddressTable = Dict[str, PeerAddresses]
+
+# Maximum number of [Peer] sections in the section cache
+SECTION_CACHE_SIZE = 16384
+
+
+class SectionCacheStats(NamedTuple):
+  hits: int
+  misses: int
+  size: int
+
+
+class SectionCache():
+  """ Least recently used cache of rendered [Peer] sections
+
+  A section is stored under a tuple of all inputs it is rendered from. """
+  def __init__(self, max_size: int):
+    self.__max_size = max_size
+    self.__sections = OrderedDict()
+    self.__lock = threading.Lock()
+    self.__hits = 0
+    self.__misses = 0
+
+  @property
+  def stats(self) -> SectionCacheStats:
+    with self.__lock:
+      return SectionCacheStats(hits=self.__hits,
+                               misses=self.__misses,
+                               size=len(self.__sections))
+
+  def get(self, key: tuple) -> Optional[str]:
+    """ Get a section, None if it is not cached """
+
+    with self.__lock:
+      section = self.__sections.get(key)
+      if section is None:
+        self.__misses += 1
+      else:
+        self.__hits += 1
+        self.__sections.move_to_end(key)
+      return section
+
+  def add(self, key: tuple, section: str):
+    """ Add a section and drop the least recently used one if necessary """
+
+    with self.__lock:
+      self.__sections[key] = section
+      self.__sections.move_to_end(key)
+      if len(self.__sections) > self.__max_size:
+        self.__sections.popitem(last=False)
+
+  def clear(self):
+    with self.__lock:
+      self.__sections.clear()
+      self.__hits = 0
+      self.__misses = 0
+
+
+# Shared by all sites and renders of the process
+__section_cache = SectionCache(SECTION_CACHE_SIZE)
+
+
+def write_config(site: SiteItems,
+                 wg_config_path: str,
+                 workers: int = 1,
+                 output_mode: str = "incremental",
+                 syncconf: bool = False,
+                 aggregate: bool = False,
+                 nftables_path: str = "") -> ConfigWriteResult:
+  """ Create the wireguard config files from the site parameters
+
+  Only config files whose inputs changed since the last run are rendered and
+  only files whose content differs from the file on disk are written. Config
+  files of peers that do not exist anymore are deleted. The fingerprints of
+  the inputs are stored in a manifest in wg_config_path.
+
+  With more than one worker the config files are rendered by a pool of worker
+  processes. The files are always written by the calling process.
+
+  In "staged" output mode the files are written to a new directory next to
+  wg_config_path, which replaces wg_config_path as a whole. Unchanged files
+  are hard linked into the new directory.
+
+  In the archive output modes all config files are written into the archive
+  wg_config_path + "." + output_mode, see write_config_archive.
+
+  With syncconf a file for wg setconf/syncconf (wg_<peer>.setconf) is written
+  next to every wg-quick file from the same rendered sections.
+
+  With aggregate the AllowedIPs of every [Peer] section are merged with
+  aggregate_allowed_ips.
 
+  With nftables_path an nftables ruleset (wg_<peer>.nft) is written next to
+  every config file, see render_nftables_ruleset. nftables_path is the
+  directory of the rulesets on the peers, they are loaded from there by
+  PostUp. """
 
-def write_config(site: SiteItems, wg_config_path: str) -> list:
-  """ Create a json config file from the site parameters """
+  if output_mode not in OUTPUT_MODES:
+    raise ValueError(
+      f"Unknown output mode {output_mode}. Possible values are {OUTPUT_MODES}")
 
-  peer_addresses = __get_addresses_for_peers(
-    site["peers"], [ipaddress.ip_network(n) for n in site["ip_networks"]])
+  if output_mode in ARCHIVE_FORMATS:
+    return write_config_archive(site,
+                                wg_config_path,
+                                output_mode,
+                                workers=workers,
+                                syncconf=syncconf,
+                                aggregate=aggregate,
+                                nftables_path=nftables_path)
 
-  prepare_directory(wg_config_path)
+  address_table = __get_address_table(site)
+  adjacency = get_adjacency(site["peers"])
 
-  created_files = []
+  if os.path.isdir(wg_config_path):
+    manifest, saved_counts = __read_manifest(wg_config_path)
+  else:
+    manifest, saved_counts = {}, {}
+  new_manifest = {}
+  new_saved_counts = {}
   for p in site["peers"]:
-    created_files.append(
-      write_file(os.path.join(wg_config_path, f"wg_{p}.conf"),
-                 __get_peer_config(p, site["peers"], peer_addresses)))
-  return created_files
+    # Peers with own keys have no private key and therefore no config file
+    if not is_own_key_peer(site["peers"][p]):
+      fingerprint = __get_fingerprint(p, site, address_table, adjacency,
+                                      aggregate, nftables_path)
+      for f in __get_file_names(p, syncconf, nftables_path):
+        new_manifest[f] = fingerprint
+
+  if output_mode == "staged":
+    output_path = stage_directory(wg_config_path, list(new_manifest))
+  else:
+    output_path = wg_config_path
+    os.makedirs(output_path, exist_ok=True)
+
+  # A failed staged write removes the staged directory, the live one is kept
+  try:
+    result = ConfigWriteResult(written=[],
+                               unchanged=[],
+                               removed=[],
+                               saved_prefixes={})
+    outdated_peers = []
+    for p in site["peers"]:
+      file_names = __get_file_names(p, syncconf, nftables_path)
+      if file_names[0] not in new_manifest:
+        continue
+
+      unchanged = all(
+        manifest.get(f) == new_manifest[f]
+        and os.path.isfile(os.path.join(output_path, f)) for f in file_names)
+      if unchanged:
+        result.unchanged.extend(
+          os.path.join(wg_config_path, f) for f in file_names)
+      else:
+        outdated_peers.append(p)
+
+      # The count of an unchanged file is taken from the manifest, the
+      # aggregation is part of the fingerprint
+      if aggregate:
+        if not unchanged or p not in saved_counts:
+          new_saved_counts[p] = __get_saved_prefix_count(
+            p, site, address_table, adjacency)
+        else:
+          new_saved_counts[p] = saved_counts[p]
+        if new_saved_counts[p]:
+          result.saved_prefixes[p] = new_saved_counts[p]
+
+    for p, config in zip(
+        outdated_peers,
+        __render_peers(outdated_peers, site, address_table, adjacency,
+                       workers, aggregate, nftables_path)):
+      file_names = __get_file_names(p, syncconf, nftables_path)
+      stream_names = file_names[:-1] if nftables_path else file_names
+      if syncconf:
+        chunks = ((c, strip_wg_quick(c)) for c in config)
+      else:
+        chunks = ((c, ) for c in config)
+      written_files = write_chunk_streams_if_changed(
+        [os.path.join(output_path, f) for f in stream_names], chunks)
+      if nftables_path:
+        # Through a temporary file, a staged file is a link to the live one
+        written_files.append(
+          write_chunks_if_changed(os.path.join(output_path, file_names[-1]), [
+            __get_nftables_ruleset(p, site["peers"], address_table,
+                                   adjacency).encode("utf-8")
+          ]))
+      for f, written in zip(file_names, written_files):
+        if written:
+          result.written.append(os.path.join(wg_config_path, f))
+        else:
+          result.unchanged.append(os.path.join(wg_config_path, f))
+
+    # Delete config files of peers that do not exist anymore
+    # A staged directory does not contain them in the first place
+    for file_name in manifest:
+      if file_name in new_manifest:
+        continue
+      if output_mode == "staged":
+        removed = os.path.isfile(os.path.join(wg_config_path, file_name))
+      else:
+        removed = remove_file(os.path.join(wg_config_path, file_name))
+      if removed:
+        result.removed.append(os.path.join(wg_config_path, file_name))
+
+    manifest_data = {"files": new_manifest, "saved_prefixes": new_saved_counts}
+    write_file_if_changed(os.path.join(output_path, MANIFEST_FILE_NAME),
+                          json.dumps(manifest_data, indent=2))
+
+    if output_mode == "staged":
+      sync_directory(output_path, [
+        MANIFEST_FILE_NAME,
+        *[os.path.basename(f) for f in result.written],
+      ])
+  except BaseException:
+    if output_mode == "staged":
+      delete_directory(output_path)
+    raise
+
+  if output_mode == "staged":
+    swap_directory(output_path, wg_config_path)
+
+  return result
+
+
+def write_config_archive(site: SiteItems,
+                         wg_config_path: str,
+                         archive_format: str,
+                         workers: int = 1,
+                         syncconf: bool = False,
+                         aggregate: bool = False,
+                         nftables_path: str = "") -> ConfigWriteResult:
+  """ Write the wireguard config files of a site into one archive
+
+  The archive is always written completely, every config file is added as
+  soon as it is rendered. The sha256 hashes and sizes of the members are
+  stored in an index next to the archive. Compared to the last index, members
+  with a new hash are reported as written and missing members as removed. """
+
+  archive_path = f"{wg_config_path}.{archive_format}"
+  index_path = archive_path + ARCHIVE_INDEX_SUFFIX
+
+  address_table = __get_address_table(site)
+  adjacency = get_adjacency(site["peers"])
+  peer_names = [
+    p for p in site["peers"] if not is_own_key_peer(site["peers"][p])
+  ]
+
+  os.makedirs(os.path.dirname(os.path.abspath(archive_path)), exist_ok=True)
+  try:
+    old_index = json.loads(read_file(index_path))["members"]
+  except (json.JSONDecodeError, KeyError):
+    old_index = {}
+
+  def members():
+    for p, config in zip(
+        peer_names,
+        __render_peers(peer_names, site, address_table, adjacency, workers,
+                       aggregate, nftables_path)):
+      if syncconf:
+        # Both members are created from the same rendered config
+        data = b"".join(config)
+        yield f"wg_{p}.conf", [data]
+        yield f"wg_{p}.setconf", [strip_wg_quick(data)]
+      else:
+        yield f"wg_{p}.conf", config
+      if nftables_path:
+        yield f"wg_{p}.nft", [
+          __get_nftables_ruleset(p, site["peers"], address_table,
+                                 adjacency).encode("utf-8")
+        ]
+
+  index = write_archive(archive_path, archive_format, members())
+
+  result = ConfigWriteResult(written=[],
+                             unchanged=[],
+                             removed=[],
+                             saved_prefixes=__get_saved_prefixes(
+                               site, address_table, adjacency, aggregate))
+  for file_name in index:
+    if old_index.get(file_name) == index[file_name]:
+      result.unchanged.append(os.path.join(archive_path, file_name))
+    else:
+      result.written.append(os.path.join(archive_path, file_name))
+  for file_name in old_index:
+    if file_name not in index:
+      result.removed.append(os.path.join(archive_path, file_name))
+
+  write_file_if_changed(
+    index_path,
+    json.dumps(
+      {
+        "archive": os.path.basename(archive_path),
+        "members": index
+      }, indent=2))
+
+  return result
+
+
+def render_site(site: SiteItems,
+                adjacency: Optional[Adjacency] = None,
+                workers: int = 1,
+                syncconf: bool = False,
+                aggregate: bool = False,
+                nftables_path: str = "") -> Dict[str, bytes]:
+  """ Render the config files of all peers of a site in memory
+
+  Peers with own keys have no config file and are left out. With syncconf
+  the configs are in the format of wg setconf/syncconf. With aggregate the
+  AllowedIPs are merged with aggregate_allowed_ips. With nftables_path the
+  configs load the nftables rulesets from this directory. """
+
+  address_table = __get_address_table(site)
+  if adjacency is None:
+    adjacency = get_adjacency(site["peers"])
+  peer_names = [
+    p for p in site["peers"] if not is_own_key_peer(site["peers"][p])
+  ]
+
+  configs = {
+    p: b"".join(config)
+    for p, config in zip(
+      peer_names,
+      __render_peers(peer_names, site, address_table, adjacency, workers,
+                     aggregate, nftables_path))
+  }
+  if syncconf:
+    return {p: strip_wg_quick(configs[p]) for p in configs}
+  return configs
+
+
+def render_peer(site: SiteItems,
+                peer_name: str,
+                adjacency: Optional[Adjacency] = None,
+                syncconf: bool = False,
+                aggregate: bool = False,
+                nftables_path: str = "") -> bytes:
+  """ Render the config file of a peer in memory
+
+  Only the addresses of the peer, its connected peers and its main peer are
+  looked up. With a given adjacency the cost depends on the number of
+  connected peers and not on the size of the site. With syncconf the config
+  is in the format of wg setconf/syncconf. With aggregate the AllowedIPs are
+  merged with aggregate_allowed_ips. With nftables_path the config loads the
+  nftables ruleset from this directory. """
+
+  if is_own_key_peer(site["peers"][peer_name]):
+    raise ValueError(
+      f"Peer {peer_name} brings its own key and has no config file")
+
+  if adjacency is None:
+    adjacency = get_adjacency(site["peers"])
+  peer_names = [peer_name, *adjacency[peer_name].neighbors]
+  if adjacency[peer_name].main_peer in site["peers"]:
+    peer_names.append(adjacency[peer_name].main_peer)
+
+  config = "".join(
+    __iter_peer_config(peer_name, site["peers"],
+                       __get_address_table(site, peer_names), adjacency,
+                       __get_link_psks(site), aggregate,
+                       nftables_path)).encode("utf-8")
+  if syncconf:
+    return strip_wg_quick(config)
+  return config
+
+
+def render_nftables_ruleset(site: SiteItems,
+                           peer_name: str,
+                           adjacency: Optional[Adjacency] = None) -> bytes:
+  """ Render the nftables ruleset of a peer in memory
+
+  The ruleset is compiled from the connection graph of the site: traffic
+  from the interface is only accepted from connected peers, to connected
+  peers and the networks of the peer, and from connected peers that use the
+  peer as their gateway. See get_nftables_ruleset. """
+
+  if adjacency is None:
+    adjacency = get_adjacency(site["peers"])
+  peer_names = [peer_name, *adjacency[peer_name].neighbors]
+
+  return __get_nftables_ruleset(peer_name, site["peers"],
+                                __get_address_table(site, peer_names),
+                                adjacency).encode("utf-8")
+
+
+def strip_wg_quick(config: bytes) -> bytes:
+  """ Remove all lines with wg-quick only keys from (a part of) a config
+
+  The rest is understood by wg setconf and wg syncconf. """
+
+  return b"".join(
+    l for l in config.splitlines(keepends=True)
+    if l.split(b"=", 1)[0].strip().lower() not in WG_QUICK_KEYS)
+
+
+def read_configs(wg_config_path: str,
+                 output_mode: str = "incremental") -> Dict[str, bytes]:
+  """ Get the written wg-quick config files of a site by peer name
+
+  In the archive output modes the config files are read from the archive.
+  Nothing is changed on disk. """
+
+  configs = {}
+  if output_mode in ARCHIVE_FORMATS:
+    for name, data in read_archive(f"{wg_config_path}.{output_mode}",
+                                   output_mode).items():
+      if name.startswith("wg_") and name.endswith(".conf"):
+        configs[name[3:-5]] = data
+  elif os.path.isdir(wg_config_path):
+    for name in os.listdir(wg_config_path):
+      if name.startswith("wg_") and name.endswith(".conf"):
+        with open(os.path.join(wg_config_path, name), "rb") as f:
+          configs[name[3:-5]] = f.read()
+  return configs
+
+
+def write_configs(
+    sites: Sites,
+    wg_config_path: str,
+    workers: int,
+    output_mode: str = "incremental",
+    syncconf: bool = False,
+    aggregate: bool = False,
+    nftables_path: str = "") -> Dict[str, SiteWriteResult]:
+  """ Create the wireguard config files of all sites
+
+  The sites are written concurrently by a pool of worker processes. The
+  config files of a site are written to a directory with the name of the site
+  in wg_config_path. A failing site does not stop the other sites. """
+
+  workers = min(workers, len(sites))
+  if workers <= 1:
+    return {
+      s: __write_site_config(sites[s],
+                             os.path.join(wg_config_path, s),
+                             output_mode=output_mode,
+                             syncconf=syncconf,
+                             aggregate=aggregate,
+                             nftables_path=nftables_path)
+      for s in sites
+    }
+
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    futures = {
+      s: executor.submit(__write_site_config,
+                         sites[s],
+                         os.path.join(wg_config_path, s),
+                         output_mode=output_mode,
+                         syncconf=syncconf,
+                         aggregate=aggregate,
+                         nftables_path=nftables_path)
+      for s in sites
+    }
+    results = {}
+    for s in futures:
+      try:
+        results[s] = futures[s].result()
+      except Exception as e:
+        # The worker process itself failed
+        results[s] = SiteWriteResult(result=None, seconds=0.0, error=e)
+    return results
+
+
+def aggregate_allowed_ips(allowed_ips: List[str]) -> List[str]:
+  """ Merge overlapping and adjacent prefixes of each address family
+
+  Prefixes covered by 0.0.0.0/0 or ::/0 are dropped as well. Entries that
+  are no ip network are kept as they are. If nothing can be merged the
+  entries are returned unchanged, so their order stays the same. """
+
+  networks = {4: [], 6: []}
+  others = []
+  for a in allowed_ips:
+    try:
+      n = ipaddress.ip_network(a.strip(), strict=False)
+    except ValueError:
+      others.append(a)
+      continue
+    networks[n.version].append(n)
+
+  collapsed = [
+    str(n) for v in networks for n in ipaddress.collapse_addresses(networks[v])
+  ]
+  if len(collapsed) == len(networks[4]) + len(networks[6]):
+    return allowed_ips
+  return collapsed + others
+
+
+def get_section_cache_stats() -> SectionCacheStats:
+  """ Get hit and miss counters of the [Peer] section cache """
+
+  return __section_cache.stats
+
+
+def clear_section_cache():
+  """ Remove all [Peer] sections from the section cache """
+
+  __section_cache.clear()
+
+
+def get_adjacency(peers: Peers) -> Adjacency:
+  """ Get the connected peers of every peer
+
+  Connections to the peer itself and to peers that do not exist are
+  ignored. """
+
+  positions = {p: i for i, p in enumerate(peers)}
+  adjacency = {}
+  for p in peers:
+    ingoing = set(peers[p]["ingoing_connected_peers"]) & positions.keys()
+    outgoing = set(peers[p]["outgoing_connected_peers"]) & positions.keys()
+    ingoing.discard(p)
+    outgoing.discard(p)
+    adjacency[p] = PeerAdjacency(neighbors=sorted(ingoing | outgoing,
+                                                  key=positions.get),
+                                 ingoing=ingoing,
+                                 outgoing=outgoing,
+                                 main_peer=peers[p]["main_peer"])
+  return adjacency
 
 
 def delete_config(site_name: str, wg_config_path: str):
   """ Delete the config files for a site """
 
   delete_directory(os.path.join(wg_config_path))
+  for archive_format in ARCHIVE_FORMATS:
+    remove_file(f"{wg_config_path}.{archive_format}")
+    remove_file(f"{wg_config_path}.{archive_format}{ARCHIVE_INDEX_SUFFIX}")
 
 
-def __get_peer_config(interface_peer_name: str, peers: Peers,
-                      peer_addresses: dict):
-  """ Write config file for a peer """
-  s = __get_interface_section(interface_peer_name, peers[interface_peer_name],
-                              peer_addresses)
+def __write_site_config(site: SiteItems, wg_config_path: str,
+                        output_mode: str, syncconf: bool,
+                        aggregate: bool,
+                        nftables_path: str) -> SiteWriteResult:
+  """ Write the config files of a site and measure the time """
 
-  for p in peers:
-    if p != interface_peer_name and (
-      (p in peers[interface_peer_name]["ingoing_connected_peers"]) or
-      (p in peers[interface_peer_name]["outgoing_connected_peers"])):
-      s += __get_peer_section(p, peers[p], interface_peer_name,
-                              peers[interface_peer_name], peer_addresses)
+  start = time.perf_counter()
+  try:
+    result = write_config(site,
+                          wg_config_path,
+                          output_mode=output_mode,
+                          syncconf=syncconf,
+                          aggregate=aggregate,
+                          nftables_path=nftables_path)
+  except Exception as e:
+    return SiteWriteResult(result=None,
+                           seconds=time.perf_counter() - start,
+                           error=e)
+  return SiteWriteResult(result=result,
+                         seconds=time.perf_counter() - start,
+                         error=None)
+
+
+def __get_file_names(peer_name: str, syncconf: bool,
+                     nftables_path: str) -> List[str]:
+  """ Get the names of the config files of a peer
+
+  The wg-quick file is always the first, the nftables ruleset the last. """
+
+  file_names = [f"wg_{peer_name}.conf"]
+  if syncconf:
+    file_names.append(f"wg_{peer_name}.setconf")
+  if nftables_path:
+    file_names.append(f"wg_{peer_name}.nft")
+  return file_names
+
+
+def __read_manifest(wg_config_path: str) -> Tuple[dict, Dict[str, int]]:
+  """ Get the fingerprints of the config files and the saved AllowedIPs
+  prefixes of the peers from the last run
+
+  Without a manifest all existing config files are treated as outdated. A
+  manifest of an older version contains only the fingerprints. """
+
+  try:
+    manifest = json.loads(
+      read_file(os.path.join(wg_config_path, MANIFEST_FILE_NAME)))
+  except json.JSONDecodeError:
+    return {
+      f: None
+      for f in os.listdir(wg_config_path)
+      if f.startswith("wg_") and f.endswith(".conf")
+    }, {}
+  if "files" not in manifest:
+    return manifest, {}
+  return manifest["files"], manifest["saved_prefixes"]
+
+
+def __render_peers(peer_names: List[str], site: SiteItems,
+                   address_table: AddressTable, adjacency: Adjacency,
+                   workers: int,
+                   aggregate: bool,
+                   nftables_path: str) -> Iterator[Iterable[bytes]]:
+  """ Render the config files of the peers in the order of peer_names
 
-  return s
+  Every config file is an iterable of chunks. Without worker processes the
+  chunks are rendered while they are written. Otherwise the peers are split
+  into one contiguous chunk per worker process. """
+
+  workers = min(workers, len(peer_names))
+  if workers <= 1:
+    link_psks = __get_link_psks(site)
+    for p in peer_names:
+      yield (c.encode("utf-8") for c in __iter_peer_config(
+        p, site["peers"], address_table, adjacency, link_psks, aggregate,
+        nftables_path))
+    return
+
+  chunk_size = -(-len(peer_names) // workers)
+  chunks = [
+    peer_names[i:i + chunk_size]
+    for i in range(0, len(peer_names), chunk_size)
+  ]
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    results = executor.map(__render_peer_chunk, chunks, repeat(site),
+                           repeat(address_table), repeat(adjacency),
+                           repeat(aggregate), repeat(nftables_path))
+    for chunk in results:
+      for config in chunk:
+        yield [config]
+
+
+def __render_peer_chunk(peer_names: List[str], site: SiteItems,
+                        address_table: AddressTable, adjacency: Adjacency,
+                        aggregate: bool, nftables_path: str) -> List[bytes]:
+  """ Render the config files of some peers in a worker process """
+
+  link_psks = __get_link_psks(site)
+  return [
+    "".join(
+      __iter_peer_config(p, site["peers"], address_table, adjacency,
+                         link_psks, aggregate, nftables_path)).encode("utf-8")
+    for p in peer_names
+  ]
+
+
+def __get_link_psks(site: SiteItems) -> Optional[LinkPsks]:
+  """ In "link" mode every link has its own preshared key """
+
+  if site["psk_mode"] == "link":
+    return LinkPsks(site["psk_secret"], site["peers"])
+  return None
+
+
+def __get_nftables_ruleset(name: str, peers: Peers,
+                           address_table: AddressTable,
+                           adjacency: Adjacency) -> str:
+  """ Compile the nftables ruleset of a peer from its connections """
+
+  networks = FirewallNetworks(peers=[], local=[], gateway=[])
+  networks.local.extend(address_table[name].host_routes)
+  networks.local.extend(peers[name]["additional_allowed_ips"])
+  for p in adjacency[name].neighbors:
+    networks.peers.extend(address_table[p].host_routes)
+    networks.peers.extend(peers[p]["additional_allowed_ips"])
+    if peers[p]["main_peer"] == name:
+      redirect = peers[p]["redirect_all_traffic"]
+      for version, host_route in zip(address_table[p].versions,
+                                     address_table[p].host_routes):
+        if (version == 4 and redirect["ipv4"]) or (
+            version == 6 and (redirect["ipv6"] or peers[p]["ipv6_routing_fix"])):
+          networks.gateway.append(host_route)
+  return get_nftables_ruleset(f"wg_{name}", networks)
+
+
+def __get_saved_prefixes(site: SiteItems, address_table: AddressTable,
+                         adjacency: Adjacency,
+                         aggregate: bool) -> Dict[str, int]:
+  """ Count the AllowedIPs prefixes the aggregation saves in each config file
+
+  Only config files with savings are counted. """
+
+  if not aggregate:
+    return {}
+
+  saved_prefixes = {}
+  for p in site["peers"]:
+    if is_own_key_peer(site["peers"][p]):
+      continue
+    saved = __get_saved_prefix_count(p, site, address_table, adjacency)
+    if saved:
+      saved_prefixes[p] = saved
+  return saved_prefixes
+
+
+def __get_saved_prefix_count(interface_peer_name: str, site: SiteItems,
+                             address_table: AddressTable,
+                             adjacency: Adjacency) -> int:
+  """ Count the AllowedIPs prefixes the aggregation saves in the config file
+  of a peer """
+
+  peers = site["peers"]
+  saved = 0
+  for p in adjacency[interface_peer_name].neighbors:
+    allowed_ips = __get_allowed_ips(p, peers[p], peers[interface_peer_name],
+                                    address_table)
+    saved += len(allowed_ips) - len(aggregate_allowed_ips(allowed_ips))
+  return saved
+
+
+def __get_fingerprint(interface_peer_name: str, site: SiteItems,
+                      address_table: AddressTable, adjacency: Adjacency,
+                      aggregate: bool, nftables_path: str) -> str:
+  """ Get the fingerprint of all inputs of the config file of a peer
+
+  These are the peer itself, the keys, endpoints and addresses of its
+  connected peers and the address of its main peer. """
+
+  peers = site["peers"]
+  interface_peer = peers[interface_peer_name]
+
+  connected_peers = []
+  for p in adjacency[interface_peer_name].neighbors:
+    connected_peers.append([
+      p,
+      peers[p]["keys"]["pubkey"],
+      peers[p]["keys"]["psk"],
+      peers[p]["endpoint"],
+      peers[p]["port"],
+      peers[p]["additional_allowed_ips"],
+      list(address_table[p].addresses),
+    ])
+
+  main_peer_addresses = []
+  if interface_peer["main_peer"] in address_table:
+    main_peer_addresses = list(
+      address_table[interface_peer["main_peer"]].addresses)
+
+  inputs = {
+    "render_version": __RENDER_VERSION,
+    "ip_networks": site["ip_networks"],
+    "psk_mode": site["psk_mode"],
+    "psk_secret": site["psk_secret"] if site["psk_mode"] == "link" else "",
+    "peer": interface_peer,
+    "addresses": list(address_table[interface_peer_name].addresses),
+    "main_peer_addresses": main_peer_addresses,
+    "connected_peers": connected_peers,
+  }
+  # Only set with aggregation, so the fingerprints without it stay the same
+  if aggregate:
+    inputs["aggregate_allowed_ips"] = True
+  # The ruleset depends on which connected peers use the peer as gateway
+  if nftables_path:
+    inputs["nftables_path"] = nftables_path
+    inputs["gateway_peers"] = [[
+      p, peers[p]["redirect_all_traffic"], peers[p]["ipv6_routing_fix"]
+    ] for p in adjacency[interface_peer_name].neighbors
+                               if peers[p]["main_peer"] == interface_peer_name]
+  return hashlib.sha256(
+    json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def __iter_peer_config(interface_peer_name: str, peers: Peers,
+                       address_table: AddressTable, adjacency: Adjacency,
+                       link_psks: Optional[LinkPsks],
+                       aggregate: bool, nftables_path: str) -> Iterator[str]:
+  """ Get the config file for a peer section by section """
+
+  yield __get_interface_section(interface_peer_name,
+                                peers[interface_peer_name], address_table,
+                                nftables_path)
+
+  for p in adjacency[interface_peer_name].neighbors:
+    yield __get_peer_section(p, peers[p], interface_peer_name,
+                             peers[interface_peer_name],
+                             adjacency[interface_peer_name], address_table,
+                             link_psks, aggregate)
 
 
 def __get_interface_section(name: str, peer: PeerItems,
-                            peer_addresses: dict) -> str:
+                            address_table: AddressTable,
+                            nftables_path: str) -> str:
   """ Get the interface section of a config file for a peer"""
 
-  s = f"# {name}\n"
-  s += "[Interface]\n"
-  s += __get_address_line(name, peer_addresses)
+  lines = [f"# {name}\n", "[Interface]\n"]
+  lines.append("Address = " + address_table[name].address + "\n")
   if peer["ingoing_connected_peers"]:
-    s += f"ListenPort = {peer['port']}\n"
-  # TODO: firewall rules
+    lines.append(f"ListenPort = {peer['port']}\n")
   if peer["redirect_all_traffic"]["ipv4"] or peer["redirect_all_traffic"][
       "ipv6"]:
     if peer["dns"]:
-      s += f"DNS = "
-      for a in peer["dns"]:
-        s += f"{a}, "
-      s = s[:-2] + "\n"
+      lines.append("DNS = " + ", ".join(peer["dns"]) + "\n")
     else:
-      s += f"DNS = 1.1.1.1, 8.8.8.8\n"
-  s += f"PrivateKey = " + peer["keys"]["privkey"] + "\n"
+      lines.append("DNS = 1.1.1.1, 8.8.8.8\n")
+  lines.append("PrivateKey = " + peer["keys"]["privkey"] + "\n")
 
   post_up = ""
   post_down = ""
+  if nftables_path:
+    post_up += get_nftables_post_up(
+      nftables_path.rstrip("/") + f"/wg_{name}.nft") + " "
+    post_down += get_nftables_post_down(f"wg_{name}") + " "
   if peer["ipv6_routing_fix"]:
-    for network in peer_addresses[name]:
-      if peer_addresses[name][network].version == 6:
-        post_up += f"ip -6 rule add from {peer_addresses[name][network]} table 501; ip -6 route add default via {peer_addresses[peer['main_peer']][network]} table 501; ip -6 rule delete table 51820; ip -6 rule delete table main suppress_prefixlength 0;"
+    addresses = address_table[name]
+    for i, version in enumerate(addresses.versions):
+      if version == 6:
+        post_up += f"ip -6 rule add from {addresses.addresses[i]} table 501; ip -6 route add default via {address_table[peer['main_peer']].addresses[i]} table 501; ip -6 rule delete table 51820; ip -6 rule delete table main suppress_prefixlength 0;"
         break
     post_down += "ip -6 rule delete table 501;"
     post_up += " "
@@ -89,94 +906,141 @@ def __get_interface_section(name: str, peer: PeerItems,
   post_up += peer["post_up"]
   post_down += peer["post_down"]
   if post_up:
-    s += f"PostUp = {post_up}\n"
+    lines.append(f"PostUp = {post_up}\n")
   if post_down:
-    s += f"PostDown = {post_down}\n"
-  s += "\n"
-  return s
+    lines.append(f"PostDown = {post_down}\n")
+  lines.append("\n")
+  return "".join(lines)
 
 
 def __get_peer_section(name: str, peer: PeerItems, interface_peer_name: str,
-                       interface_peer: PeerItems, peer_addresses: dict):
-  """ Get the peer section of a config file """
+                       interface_peer: PeerItems,
+                       interface_adjacency: PeerAdjacency,
+                       address_table: AddressTable,
+                       link_psks: Optional[LinkPsks], aggregate: bool) -> str:
+  """ Get the peer section of a config file
 
-  s = f"# {name}\n"
-  s += f"[Peer]\n"
-  if peer["endpoint"] and name in interface_peer["outgoing_connected_peers"]:
-    s += f"Endpoint = {peer['endpoint']}:{peer['port']}\n"
-    if interface_peer["persistent_keep_alive"] == 25:
-      s += "PersistentKeepAlive = 25\n"
-  s += f"PublicKey = " + peer["keys"]["pubkey"] + "\n"
+  Sections are taken from the section cache if all their inputs are the same,
+  so a peer that appears in many config files is rendered only once. """
+
+  endpoint = ""
+  if peer["endpoint"] and name in interface_adjacency.outgoing:
+    endpoint = f"{peer['endpoint']}:{peer['port']}"
 
-  # Always the psk of the outgoing_connected_peers is used
+  # A peer with its own key is configured with its own psk, so it is used
+  # for all of its links (also in "link" mode)
+  # In "link" mode the psk is derived from the site secret and both peer names
+  # Otherwise always the psk of the outgoing_connected_peers is used
   # If a peer is ingoing and outgoing the psk of the alphebetically first peer is used
-  if name in interface_peer[
-      "ingoing_connected_peers"] and name in interface_peer[
-        "outgoing_connected_peers"]:
+  if is_own_key_peer(peer):
+    psk = peer["keys"]["psk"]
+  elif is_own_key_peer(interface_peer):
+    psk = interface_peer["keys"]["psk"]
+  elif link_psks is not None:
+    psk = link_psks.get_psk(name, interface_peer_name)
+  elif (name in interface_adjacency.ingoing
+        and name in interface_adjacency.outgoing):
     l = [name, interface_peer_name]
     l.sort()
     if name == l[0]:
-      s += f"PresharedKey = " + peer["keys"]["psk"] + "\n"
+      psk = peer["keys"]["psk"]
     else:
-      s += f"PresharedKey = " + interface_peer["keys"]["psk"] + "\n"
-  elif name in interface_peer["ingoing_connected_peers"]:
-    s += f"PresharedKey = " + peer["keys"]["psk"] + "\n"
+      psk = interface_peer["keys"]["psk"]
+  elif name in interface_adjacency.ingoing:
+    psk = peer["keys"]["psk"]
   else:
     # Peer has to be outgoing_connected_peer
-    s += f"PresharedKey = " + interface_peer["keys"]["psk"] + "\n"
-  s += __get_allowed_ips_line(
+    psk = interface_peer["keys"]["psk"]
+
+  # Everything the section is rendered from
+  is_main_peer = name == interface_peer["main_peer"]
+  key = (
+    name,
+    peer["keys"]["pubkey"],
+    psk,
+    endpoint,
+    bool(endpoint) and interface_peer["persistent_keep_alive"] == 25,
+    address_table[name].host_routes,
+    tuple(peer["additional_allowed_ips"]),
+    is_main_peer and interface_peer["redirect_all_traffic"]["ipv4"],
+    is_main_peer and (interface_peer["redirect_all_traffic"]["ipv6"]
+                      or interface_peer["ipv6_routing_fix"]),
+    aggregate,
+  )
+  section = __section_cache.get(key)
+  if section is not None:
+    return section
+
+  lines = [f"# {name}\n", "[Peer]\n"]
+  if endpoint:
+    lines.append(f"Endpoint = {endpoint}\n")
+    if interface_peer["persistent_keep_alive"] == 25:
+      lines.append("PersistentKeepAlive = 25\n")
+  lines.append("PublicKey = " + peer["keys"]["pubkey"] + "\n")
+  lines.append("PresharedKey = " + psk + "\n")
+  allowed_ips = __get_allowed_ips(
     peer_name=name,
     peer=peer,
     interface_peer=interface_peer,
-    peer_addresses=peer_addresses,
+    address_table=address_table,
   )
-  s += "\n"
-  return s
+  if aggregate:
+    allowed_ips = aggregate_allowed_ips(allowed_ips)
+  lines.append("AllowedIPs = " + ", ".join(allowed_ips) + "\n")
+  lines.append("\n")
+  section = "".join(lines)
+  __section_cache.add(key, section)
+  return section
 
 
-def __get_addresses_for_peers(peers: tuple, ip_networks: list):
-  """ Create ip addresses for each peer """
+def __get_address_table(site: SiteItems,
+                        peer_names: Optional[List[str]] = None) -> AddressTable:
+  """ Format the stored ip addresses of each peer (or the given peers)
 
-  peer_addresses = {}
-  address_iterators = []
-  for n in ip_networks:
-    address_iterators.append([n, n.hosts()])
-  for p in peers:
-    peer_addresses.update({p: {}})
-    for i in address_iterators:
-      peer_addresses[p].update({i[0]: next(i[1])})
-  return peer_addresses
+  Every address is formatted once, all sections of a render use the
+  table. """
 
+  if peer_names is None:
+    peer_names = site["peers"]
 
-def __get_address_line(peer_name: str, peer_addresses: dict):
-  """ Create the Address line """
+  networks = [ipaddress.ip_network(n) for n in site["ip_networks"]]
+  allocations = [site["address_allocations"][str(n)] for n in networks]
+  versions = tuple(n.version for n in networks)
+  table = {}
+  for p in peer_names:
+    addresses = tuple(
+      str(n.network_address + a["peers"][p])
+      for n, a in zip(networks, allocations))
+    table[p] = PeerAddresses(
+      address=", ".join(f"{a}/{n.prefixlen}"
+                        for n, a in zip(networks, addresses)),
+      versions=versions,
+      addresses=addresses,
+      host_routes=tuple(f"{a}/{n.max_prefixlen}"
+                        for n, a in zip(networks, addresses)),
+    )
+  return table
 
-  address_line = "Address = "
-  for network in peer_addresses[peer_name].keys():
-    address_line += str(peer_addresses[peer_name][network]) + "/" + str(
-      network.prefixlen) + ", "
 
-  return address_line[:-2] + "\n"
+def __get_allowed_ips(peer_name: str, peer: PeerItems,
+                      interface_peer: PeerItems,
+                      address_table: AddressTable) -> List[str]:
+  """ Get the AllowedIPs of a peer in the config file of interface_peer """
 
+  addresses = address_table[peer_name]
+  if peer_name != interface_peer["main_peer"]:
+    return [*addresses.host_routes, *peer["additional_allowed_ips"]]
 
-def __get_allowed_ips_line(peer_name: str, peer: PeerItems,
-                           interface_peer: PeerItems, peer_addresses: dict):
-  """ Create the AllowedIPs line """
-
-  allowed_ips_line = "AllowedIPs = "
-  for network in peer_addresses[peer_name].keys():
-    if peer_name == interface_peer[
-        "main_peer"] and network.version == 4 and interface_peer[
-          "redirect_all_traffic"]["ipv4"]:
-      allowed_ips_line += "0.0.0.0/0, "
-    elif peer_name == interface_peer["main_peer"] and network.version == 6 and (
-        interface_peer["redirect_all_traffic"]["ipv6"]
-        or interface_peer["ipv6_routing_fix"]):
-      allowed_ips_line += "::/0, "
+  redirect_ipv4 = interface_peer["redirect_all_traffic"]["ipv4"]
+  redirect_ipv6 = (interface_peer["redirect_all_traffic"]["ipv6"]
+                   or interface_peer["ipv6_routing_fix"])
+  allowed_ips = []
+  for version, host_route in zip(addresses.versions, addresses.host_routes):
+    if version == 4 and redirect_ipv4:
+      allowed_ips.append("0.0.0.0/0")
+    elif version == 6 and redirect_ipv6:
+      allowed_ips.append("::/0")
     else:
-      allowed_ips_line += str(peer_addresses[peer_name][network]) + "/" + str(
-        network.max_prefixlen) + ", "
-  for s in peer["additional_allowed_ips"]:
-    allowed_ips_line += s + ", "
-
-  return allowed_ips_line[:-2] + "\n"
+      allowed_ips.append(host_route)
+  allowed_ips.extend(peer["additional_allowed_ips"])
+  return allowed_ips
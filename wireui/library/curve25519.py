@@ -0,0 +1,74 @@
+# curve25519.py
+# X25519 scalar multiplication (RFC 7748) for in-process key creation
+# Author: Tim Schlottmann
+
+__P = 2**255 - 19
+__A24 = 121665
+__BASE_POINT = 9
+
+
+def x25519(scalar: bytes, u: bytes) -> bytes:
+  """ Multiply the point with the u-coordinate u by scalar
+
+  Both arguments and the result are 32 bytes in little endian byte order. """
+
+  if len(scalar) != 32 or len(u) != 32:
+    raise ValueError("scalar and u have to be 32 bytes long")
+
+  k = int.from_bytes(clamp(scalar), "little")
+  x_1 = int.from_bytes(u, "little") & ((1 << 255) - 1)
+  return __ladder(k, x_1).to_bytes(32, "little")
+
+
+def x25519_base(scalar: bytes) -> bytes:
+  """ Multiply the curve base point by scalar """
+
+  return x25519(scalar, __BASE_POINT.to_bytes(32, "little"))
+
+
+def clamp(scalar: bytes) -> bytes:
+  """ Clamp a 32 byte scalar as done by 'wg genkey' """
+
+  b = bytearray(scalar)
+  b[0] &= 248
+  b[31] &= 127
+  b[31] |= 64
+  return bytes(b)
+
+
+def __ladder(k: int, x_1: int) -> int:
+  """ Montgomery ladder with constant number of steps """
+
+  p = __P
+  x_2, z_2 = 1, 0
+  x_3, z_3 = x_1, 1
+  swap = 0
+  for t in range(254, -1, -1):
+    k_t = (k >> t) & 1
+    swap ^= k_t
+    if swap:
+      x_2, x_3 = x_3, x_2
+      z_2, z_3 = z_3, z_2
+    swap = k_t
+
+    a = (x_2 + z_2) % p
+    aa = a * a % p
+    b = (x_2 - z_2) % p
+    bb = b * b % p
+    e = (aa - bb) % p
+    c = (x_3 + z_3) % p
+    d = (x_3 - z_3) % p
+    da = d * a % p
+    cb = c * b % p
+    x_3 = (da + cb) % p
+    x_3 = x_3 * x_3 % p
+    z_3 = (da - cb) % p
+    z_3 = x_1 * (z_3 * z_3 % p) % p
+    x_2 = aa * bb % p
+    z_2 = e * ((aa + __A24 * e) % p) % p
+
+  if swap:
+    x_2, x_3 = x_3, x_2
+    z_2, z_3 = z_3, z_2
+
+  return x_2 * pow(z_2, p - 2, p) % p
@@ -0,0 +1,180 @@
+# diff.py
+# Section-wise comparison of wireguard config files
+# Author: Tim Schlottmann
+
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+# (old value, new value), None if the key does not exist
+ValueChange = Tuple[Optional[str], Optional[str]]
+
+# Changes of these keys are reported without their values
+SECRET_KEYS = ["PrivateKey", "PresharedKey"]
+HIDDEN_VALUE = "(hidden)"
+
+
+class CONFIG_DIFF_STATUS():
+  ADDED = "added"
+  REMOVED = "removed"
+  CHANGED = "changed"
+
+
+class ConfigDiff(NamedTuple):
+  peer_name: str
+  status: str
+  # Changed keys of the [Interface] section
+  interface: Dict[str, ValueChange]
+  # Names of the [Peer] sections that have been added or removed
+  added_peers: List[str]
+  removed_peers: List[str]
+  # Changed keys of the [Peer] sections that exist in both configs
+  changed_peers: Dict[str, Dict[str, ValueChange]]
+
+
+class ConfigSection(NamedTuple):
+  text: str
+  # Name of the section from the comment above it or the public key
+  name: str
+  header: str
+
+
+def diff_configs(old: Mapping[str, bytes],
+                 new: Mapping[str, bytes]) -> Dict[str, ConfigDiff]:
+  """ Compare the config files of the peers of a site
+
+  old and new map the peer names to their config files. Only config files
+  that differ are part of the result. Sections with the same text are not
+  parsed any further. """
+
+  diffs = {}
+  for p in new:
+    if p not in old:
+      diffs[p] = diff_config(p, None, new[p])
+    elif old[p] != new[p]:
+      diffs[p] = diff_config(p, old[p], new[p])
+  for p in old:
+    if p not in new:
+      diffs[p] = diff_config(p, old[p], None)
+  return diffs
+
+
+def diff_config(peer_name: str, old: Optional[bytes],
+                new: Optional[bytes]) -> ConfigDiff:
+  """ Compare two versions of the config file of a peer """
+
+  if old is None:
+    status = CONFIG_DIFF_STATUS.ADDED
+  elif new is None:
+    status = CONFIG_DIFF_STATUS.REMOVED
+  else:
+    status = CONFIG_DIFF_STATUS.CHANGED
+
+  old_interface, old_peers = split_config(old or b"")
+  new_interface, new_peers = split_config(new or b"")
+
+  interface = {}
+  if old_interface != new_interface:
+    interface = __diff_section(old_interface, new_interface)
+
+  changed_peers = {}
+  for name in new_peers:
+    if name in old_peers and old_peers[name] != new_peers[name]:
+      changed_peers[name] = __diff_section(old_peers[name], new_peers[name])
+
+  return ConfigDiff(
+    peer_name=peer_name,
+    status=status,
+    interface=interface,
+    added_peers=[n for n in new_peers if n not in old_peers],
+    removed_peers=[n for n in old_peers if n not in new_peers],
+    changed_peers=changed_peers,
+  )
+
+
+def split_config(config: bytes) -> Tuple[Optional[str], Dict[str, str]]:
+  """ Split a config file into the [Interface] section and the [Peer] sections
+
+  The [Peer] sections are named after the comment above them or, if there
+  is none, after their public key. """
+
+  interface = None
+  peers = {}
+  for section in __iter_sections(config.decode("utf-8")):
+    if section.header == "[Interface]":
+      interface = section.text
+    else:
+      peers[section.name] = section.text
+  return interface, peers
+
+
+def __iter_sections(config: str):
+  """ Get the sections of a config file with their leading comments """
+
+  lines = []
+  comment = ""
+  section_comment = ""
+  header = None
+  for line in config.splitlines():
+    stripped = line.strip()
+    if stripped.startswith("[") and stripped.endswith("]"):
+      if header is not None:
+        yield __get_section(lines, section_comment, header)
+      header = stripped
+      section_comment = comment
+      comment = ""
+      lines = [line]
+      continue
+    if header is None or (stripped.startswith("#") and not lines[-1].strip()):
+      # A comment after a blank line belongs to the next section
+      if stripped.startswith("#"):
+        comment = stripped[1:].strip()
+      continue
+    lines.append(line)
+  if header is not None:
+    yield __get_section(lines, section_comment, header)
+
+
+def __get_section(lines: List[str], comment: str,
+                  header: str) -> ConfigSection:
+  name = comment or __parse_section("\n".join(lines)).get("PublicKey", "")
+  return ConfigSection(text="\n".join(lines).strip(),
+                       name=name,
+                       header=header)
+
+
+def __parse_section(text: Optional[str]) -> Dict[str, str]:
+  """ Get the keys and values of a section, repeated keys are joined """
+
+  values = {}
+  for line in (text or "").splitlines():
+    key, sep, value = line.partition("=")
+    if not sep or line.lstrip().startswith("#"):
+      continue
+    key = key.strip()
+    if key in values:
+      values[key] += ", " + value.strip()
+    else:
+      values[key] = value.strip()
+  return values
+
+
+def __diff_section(old: Optional[str],
+                   new: Optional[str]) -> Dict[str, ValueChange]:
+  """ Get the keys whose values differ between two sections """
+
+  old_values = __parse_section(old)
+  new_values = __parse_section(new)
+  changes = {}
+  for k in [*new_values, *[k for k in old_values if k not in new_values]]:
+    if old_values.get(k) == new_values.get(k):
+      continue
+    if k in SECRET_KEYS:
+      changes[k] = (HIDDEN_VALUE if k in old_values else None,
+                    HIDDEN_VALUE if k in new_values else None)
+    else:
+      changes[k] = (old_values.get(k), new_values.get(k))
+  return changes
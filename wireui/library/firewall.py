@@ -0,0 +1,118 @@
+# firewall.py
+# Create nftables rulesets for the wireguard interfaces
+# Author: Tim Schlottmann
+
+import ipaddress
+import re
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+
+
+class FirewallNetworks(NamedTuple):
+  # Addresses and networks of the connected peers
+  peers: List[str]
+  # Addresses and networks of the peer itself
+  local: List[str]
+  # Addresses of connected peers that send all their traffic through the peer
+  gateway: List[str]
+
+
+def get_table_name(interface_name: str) -> str:
+  """ Get the name of the nftables table of an interface """
+
+  return "wireui_" + re.sub(r"[^A-Za-z0-9_]", "_", interface_name)
+
+
+def get_nftables_ruleset(interface_name: str,
+                         networks: FirewallNetworks) -> str:
+  """ Create the nftables ruleset of a wireguard interface
+
+  The allowed addresses are stored in named sets, so every packet is checked
+  with a constant number of set lookups, independent of the number of peers.
+  Packets from the interface are accepted
+
+  * as input if they come from a connected peer,
+  * as forward if they come from a connected peer and go to another connected
+    peer or to a network of the peer itself,
+  * as forward if they come from a connected peer that uses the peer as its
+    gateway (main peer with redirection of all traffic),
+
+  all other packets from the interface are dropped. The ruleset replaces an
+  existing table of the interface in one transaction when it is loaded with
+  nft -f. """
+
+  table = get_table_name(interface_name)
+  interface = '"' + interface_name.replace('"', '') + '"'
+
+  lines = [
+    f"# {interface_name}\n",
+    f"table inet {table}\n",
+    f"delete table inet {table}\n",
+    f"table inet {table} {{\n",
+  ]
+  for set_name, elements in __get_sets(networks).items():
+    lines.append(f"  set {set_name} {{\n")
+    lines.append(f"    type {'ipv4_addr' if set_name[-1] == '4' else 'ipv6_addr'}\n")
+    lines.append("    flags interval\n")
+    if elements:
+      lines.append("    elements = { " + ", ".join(elements) + " }\n")
+    lines.append("  }\n")
+
+  for chain in ["input", "forward"]:
+    lines.append(f"  chain {chain} {{\n")
+    lines.append(
+      f"    type filter hook {chain} priority filter; policy accept;\n")
+    lines.append(f"    iifname {interface} ct state established,related accept\n")
+    for family, version in [("ip", 4), ("ip6", 6)]:
+      if chain == "input":
+        lines.append(
+          f"    iifname {interface} {family} saddr @peers_ipv{version} accept\n")
+      else:
+        lines.append(
+          f"    iifname {interface} {family} saddr @peers_ipv{version} {family} daddr @peers_ipv{version} accept\n"
+        )
+        lines.append(
+          f"    iifname {interface} {family} saddr @peers_ipv{version} {family} daddr @local_ipv{version} accept\n"
+        )
+        lines.append(
+          f"    iifname {interface} {family} saddr @gateway_ipv{version} accept\n"
+        )
+    lines.append(f"    iifname {interface} drop\n")
+    lines.append("  }\n")
+  lines.append("}\n")
+  return "".join(lines)
+
+
+def get_nftables_post_up(ruleset_path: str) -> str:
+  """ Get the command that loads a ruleset """
+
+  return f"nft -f {ruleset_path};"
+
+
+def get_nftables_post_down(interface_name: str) -> str:
+  """ Get the command that removes the ruleset of an interface """
+
+  return f"nft delete table inet {get_table_name(interface_name)};"
+
+
+def __get_sets(networks: FirewallNetworks) -> Dict[str, List[str]]:
+  """ Get the elements of all sets of a ruleset
+
+  Overlapping networks are merged, because they are not allowed in an
+  interval set. Entries that are no ip network are left out. """
+
+  sets = {}
+  for name, entries in networks._asdict().items():
+    parsed = {4: [], 6: []}
+    for e in entries:
+      try:
+        n = ipaddress.ip_network(e.strip(), strict=False)
+      except ValueError:
+        continue
+      parsed[n.version].append(n)
+    for version in [4, 6]:
+      sets[f"{name}_ipv{version}"] = [
+        str(n) for n in ipaddress.collapse_addresses(parsed[version])
+      ]
+  return sets
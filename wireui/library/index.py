@@ -0,0 +1,116 @@
+# index.py
+# Index of all keys across all sites
+# Author: Tim Schlottmann
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from .keys import is_valid_key
+
+from .typedefs import MESSAGE_LEVEL
+from .typedefs import Keys
+from .typedefs import Message
+from .typedefs import MessageContent
+from .typedefs import Result
+
+
+class KEY_INDEX_MESSAGE_TYPE():
+  @property
+  def KEY_MALFORMED():
+    return 0
+
+  @property
+  def KEY_DUPLICATE():
+    return 1
+
+
+class KeyIndexMessageContent(MessageContent):
+  message_type: int
+  key: str
+  site: str
+  peer: str
+
+
+KeyIndexMessage = Message[KeyIndexMessageContent]
+
+# (site name, peer name, key name)
+KeyOwner = Tuple[str, str, str]
+
+
+class KeyIndex():
+  """ Hash index over the public, private and preshared keys of all sites """
+  def __init__(self):
+    # The owners of a key are stored in a dict to keep the insertion order
+    self.__owners: Dict[str, Dict[KeyOwner, None]] = {}
+
+  def add_peer(self, site_name: str, peer_name: str, keys: Keys) -> Result:
+    """ Add the keys of a peer
+
+    Malformed keys and keys that are already used by another peer are
+    reported in the result. """
+
+    r = Result()
+    for k in keys:
+      value = keys[k]
+      if not isinstance(value, str):
+        continue
+
+      if not is_valid_key(value):
+        r.append(
+          KeyIndexMessage(message_level=MESSAGE_LEVEL.ERROR,
+                          message=KeyIndexMessageContent(
+                            message_type=KEY_INDEX_MESSAGE_TYPE.KEY_MALFORMED,
+                            key=k,
+                            site=site_name,
+                            peer=peer_name)))
+
+      owners = self.__owners.setdefault(value, {})
+      for owner in owners:
+        if owner[:2] != (site_name, peer_name):
+          r.append(
+            KeyIndexMessage(
+              message_level=MESSAGE_LEVEL.ERROR,
+              message=KeyIndexMessageContent(
+                message_type=KEY_INDEX_MESSAGE_TYPE.KEY_DUPLICATE,
+                key=k,
+                site=owner[0],
+                peer=owner[1])))
+          break
+      owners[(site_name, peer_name, k)] = None
+    return r
+
+  def remove_peer(self, site_name: str, peer_name: str, keys: Keys):
+    """ Remove the keys of a peer """
+
+    for k in keys:
+      value = keys[k]
+      if not isinstance(value, str) or value not in self.__owners:
+        continue
+
+      self.__owners[value].pop((site_name, peer_name, k), None)
+      if not self.__owners[value]:
+        del self.__owners[value]
+
+  def find_pubkey(self, pubkey: str) -> Optional[Tuple[str, str]]:
+    """ Get site name and peer name of the peer with the public key """
+
+    for owner in self.__owners.get(pubkey, {}):
+      if owner[2] == "pubkey":
+        return owner[0], owner[1]
+    return None
+
+  def get_duplicates(self) -> Dict[str, List[KeyOwner]]:
+    """ Get all keys that are used more than once """
+
+    return {
+      k: list(owners)
+      for k, owners in self.__owners.items() if len(owners) > 1
+    }
+
+  def __len__(self) -> int:
+    return len(self.__owners)
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.__owners
@@ -10,12 +10,19 @@ from typing import NamedTuple
 from typing import Optional
 from typing import Tuple
 
+from .addresses import AddressAllocator
+
 from .helpers import convert_list_to_str
 from .helpers import get_default_dns
 
-from .keys import get_keys
+from .index import KeyIndex
+
+from .keys import get_psk
+from .keys import is_valid_key
+from .keys import PSK_MODES
 
 from .typedefs import MESSAGE_LEVEL
+from .typedefs import AddressPoolExhaustedError
 from .typedefs import DataIntegrityError
 from .typedefs import DataIntegrityMessage
 from .typedefs import DataIntegrityResult
@@ -33,14 +40,12 @@ version_dict = {
   "0.1.1": 2,
   "0.1.2": 3,
   "0.1.3": 4,
+  "0.1.4": 5,
+  "0.1.5": 6,
 }
 
 settings_latest_version = "0.1.2"
-site_latest_version = "0.1.3"
-
-
-def check_wireguard():
-  get_keys()
+site_latest_version = "0.1.5"
 
 
 # Data check recipe
@@ -56,10 +61,17 @@ def check_wireguard():
 ##########################################################################################
 
 
-def check_imported_sites(sites: Sites) -> DataIntegrityResult:
-  """ Check data integrity of the sites """
+def check_imported_sites(
+    sites: Sites,
+    key_index: Optional[KeyIndex] = None) -> DataIntegrityResult:
+  """ Check data integrity of the sites
+
+  The keys of all peers are added to key_index, which detects malformed and
+  duplicate keys. """
 
   data_integrity_result = DataIntegrityResult()
+  if key_index is None:
+    key_index = KeyIndex()
 
   for s in sites:
     data_integrity_message = DataIntegrityMessage()
@@ -91,10 +103,22 @@ def check_imported_sites(sites: Sites) -> DataIntegrityResult:
         # Update routines for config_version 0.1.2
         if sites[s]["config_version"] == "0.1.2":
           sites[s]["config_version"] = "0.1.3"
+        # Update routines for config_version 0.1.3
+        if sites[s]["config_version"] == "0.1.3":
+          sites[s]["psk_mode"] = "peer"
+          sites[s]["psk_secret"] = get_psk()
+          sites[s]["config_version"] = "0.1.4"
+        # Update routines for config_version 0.1.4
+        # The addresses are allocated below in the order of the peers, which
+        # results in the same addresses as before
+        if sites[s]["config_version"] == "0.1.4":
+          sites[s]["address_allocations"] = {}
+          sites[s]["config_version"] = "0.1.5"
 
     # Data integrity check
 
     # Check ip_networks
+    ip_networks_valid = False
     r1, r2 = __check_key(sites[s], "ip_networks", [list])
     site_result.append(r1)
     site_result.append(r2)
@@ -107,6 +131,7 @@ def check_imported_sites(sites: Sites) -> DataIntegrityResult:
       if success:
         r, allow_ipv4, allow_ipv6 = check_ip_networks(sites[s]["ip_networks"])
         site_result.append(r)
+        ip_networks_valid = r.get_success()
 
     # Check DNS servers
     r1, r2 = __check_key(sites[s], "dns", [list])
@@ -124,15 +149,54 @@ def check_imported_sites(sites: Sites) -> DataIntegrityResult:
                       allow_ipv6=allow_ipv6)
         site_result.append(r)
 
+    # Check psk_mode and psk_secret
+    r1, r2 = __check_key(sites[s], "psk_mode", [str])
+    site_result.append(r1)
+    site_result.append(r2)
+    psk_mode_valid = r1.get_success() and r2.get_success()
+    r1, r2 = __check_key(sites[s], "psk_secret", [str])
+    site_result.append(r1)
+    site_result.append(r2)
+    if psk_mode_valid and r1.get_success() and r2.get_success():
+      site_result.append(
+        check_psk(sites[s]["psk_mode"], sites[s]["psk_secret"]))
+
     # Check peers
     r1, r2 = __check_key(sites[s], "peers", [dict])
     site_result.append(r1)
     site_result.append(r2)
-    if r1.get_success() and r2.get_success():
+    peers_valid = r1.get_success() and r2.get_success()
+    if peers_valid:
       peer_results = check_peer_integrity(Peers(sites[s]["peers"]), s,
-                                          allow_ipv4, allow_ipv6, version_old)
+                                          allow_ipv4, allow_ipv6, version_old,
+                                          key_index)
     else:
       peer_results = []
+
+    # Check address_allocations
+    # Peers without an address get one, addresses of unknown peers are released
+    r1, r2 = __check_key(sites[s], "address_allocations", [dict])
+    site_result.append(r1)
+    site_result.append(r2)
+    if (r1.get_success() and r2.get_success() and ip_networks_valid
+        and peers_valid):
+      allocator = AddressAllocator(sites[s]["ip_networks"],
+                                   sites[s]["address_allocations"])
+      allocator.free_unknown(list(sites[s]["peers"]))
+      try:
+        for p in sites[s]["peers"]:
+          allocator.allocate(p)
+      except AddressPoolExhaustedError as e:
+        r = Result()
+        r.append(
+          IPNetworkMessage(
+            message_level=MESSAGE_LEVEL.ERROR,
+            message=IPNetworkMessageContent(
+              message_type=IP_NETWORK_MESSAGE_TYPE.NETWORK_EXHAUSTED,
+              ip_network=e.network,
+              prefix=ipaddress.ip_network(e.network).prefixlen)))
+        site_result.append(r)
+
     data_integrity_message.site_result = site_result
     data_integrity_message.peer_results = peer_results
     data_integrity_result.setitem(data_integrity_message)
@@ -140,9 +204,13 @@ def check_imported_sites(sites: Sites) -> DataIntegrityResult:
   return data_integrity_result
 
 
-def check_peer_integrity(peers: Peers, site_name: str, allow_ipv4: bool,
-                         allow_ipv6: bool,
-                         version_old: str) -> List[ResultList]:
+def check_peer_integrity(
+    peers: Peers,
+    site_name: str,
+    allow_ipv4: bool,
+    allow_ipv6: bool,
+    version_old: str,
+    key_index: Optional[KeyIndex] = None) -> List[ResultList]:
 
   peer_results: List[ResultList] = []
   for p in peers:
@@ -181,6 +249,10 @@ def check_peer_integrity(peers: Peers, site_name: str, allow_ipv4: bool,
             "ipv6": False
           })
         version = "0.1.3"
+      if version == "0.1.3":
+        version = "0.1.4"
+      if version == "0.1.4":
+        version = "0.1.5"
 
     # Data integrity check
 
@@ -193,6 +265,10 @@ def check_peer_integrity(peers: Peers, site_name: str, allow_ipv4: bool,
         r1, r2 = __check_key(peers[p]["keys"], k, [str])
         rl.append(r1)
         rl.append(r2)
+      rl.append(__check_key_presence(peers[p]["keys"], "pubkey"))
+      rl.append(__check_key_presence(peers[p]["keys"], "psk"))
+      if key_index is not None:
+        rl.append(key_index.add_peer(site_name, p, peers[p]["keys"]))
 
     # Check additional allowed ips
     r1, r2 = __check_key(peers[p], "additional_allowed_ips", [list])
@@ -320,6 +396,16 @@ def check_imported_settings(settings: Settings) -> Settings:
   r1, r2 = __check_key(settings, "sites_file_path", [str])
   r1, r2 = __check_key(settings, "wg_config_path", [str])
   r1, r2 = __check_key(settings, "editor", [str])
+  r1, r2 = __check_key(settings, "key_backend", [str])
+  r1, r2 = __check_key(settings, "key_pool_low_watermark", [int])
+  r1, r2 = __check_key(settings, "key_pool_high_watermark", [int])
+  r1, r2 = __check_key(settings, "wg_probe_cache_path", [str])
+  r1, r2 = __check_key(settings, "async_concurrency", [int])
+  r1, r2 = __check_key(settings, "render_workers", [int])
+  r1, r2 = __check_key(settings, "output_mode", [str])
+  r1, r2 = __check_key(settings, "syncconf_files", [bool])
+  r1, r2 = __check_key(settings, "aggregate_allowed_ips", [bool])
+  r1, r2 = __check_key(settings, "nftables_path", [str])
 
   return settings
 
@@ -342,6 +428,10 @@ class IP_NETWORK_MESSAGE_TYPE():
   def SET_DEFAULT():
     return 2
 
+  @property
+  def NETWORK_EXHAUSTED():
+    return 3
+
 
 class IPNetworkMessageContent(MessageContent):
   message_type: int
@@ -707,6 +797,47 @@ def check_endpoint(endpoint: str,
   return r
 
 
+##########################################################################################
+# Check PSK
+##########################################################################################
+
+
+class PSK_MESSAGE_TYPE():
+  @property
+  def PSK_MODE_INVALID():
+    return 0
+
+  @property
+  def PSK_SECRET_INVALID():
+    return 1
+
+
+class PskMessageContent(MessageContent):
+  message_type: int
+  # The secret itself is not part of the message
+  psk_mode: str
+
+
+PskMessage = Message[PskMessageContent]
+
+
+def check_psk(psk_mode: str, psk_secret: str) -> Result:
+  r = Result()
+  if psk_mode not in PSK_MODES:
+    r.append(
+      PskMessage(message_level=MESSAGE_LEVEL.ERROR,
+                 message=PskMessageContent(
+                   message_type=PSK_MESSAGE_TYPE.PSK_MODE_INVALID,
+                   psk_mode=psk_mode)))
+  if not is_valid_key(psk_secret):
+    r.append(
+      PskMessage(message_level=MESSAGE_LEVEL.ERROR,
+                 message=PskMessageContent(
+                   message_type=PSK_MESSAGE_TYPE.PSK_SECRET_INVALID,
+                   psk_mode=psk_mode)))
+  return r
+
+
 ##########################################################################################
 # Check Port
 ##########################################################################################
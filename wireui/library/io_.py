@@ -1,4 +1,23 @@
+import hashlib
+import io
 import os
+import shutil
+import tarfile
+import time
+import zipfile
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+from typing import Union
+
+# Archive formats and their tarfile modes (None for zip)
+ARCHIVE_FORMATS = {
+  "tar": "w",
+  "tar.gz": "w:gz",
+  "tar.xz": "w:xz",
+  "zip": None,
+}
 
 
 def write_file(path: str, s: str = "") -> str:
@@ -9,6 +28,167 @@ def write_file(path: str, s: str = "") -> str:
   return path
 
 
+def write_file_if_changed(path: str, s: Union[str, bytes] = "") -> bool:
+  """ Save a string or bytes to a file if the content of the file differs
+
+  Returns if the file has been written """
+  b = s.encode("utf-8") if isinstance(s, str) else s
+  try:
+    if os.path.getsize(path) == len(b) and __get_file_hash(
+        path) == hashlib.sha256(b).digest():
+      return False
+  except FileNotFoundError:
+    pass
+
+  with open(path, "wb") as f:
+    f.write(b)
+    f.flush()
+  return True
+
+
+def write_chunks_if_changed(path: str, chunks: Iterable[bytes]) -> bool:
+  """ Stream chunks to a file if the content of the file differs
+
+  Returns if the file has been written """
+
+  return write_chunk_streams_if_changed([path], ((c, ) for c in chunks))[0]
+
+
+def write_chunk_streams_if_changed(paths: List[str],
+                                   chunks: Iterable[Tuple[bytes, ...]]
+                                   ) -> List[bool]:
+  """ Stream chunks to several files at once if their content differs
+
+  Every element of chunks holds one chunk for each path. The chunks of an
+  existing file are written to a temporary file next to it while they are
+  hashed. The temporary file replaces the file only if the content differs.
+  A file that does not exist yet is written directly.
+  Returns for every path if the file has been written """
+
+  existing = [os.path.isfile(p) for p in paths]
+  targets = [
+    os.path.join(os.path.dirname(p), "." + os.path.basename(p) +
+                 ".tmp") if e else p for p, e in zip(paths, existing)
+  ]
+  hashes = [hashlib.sha256() for _ in paths]
+  sizes = [0 for _ in paths]
+  files = []
+  try:
+    for t in targets:
+      files.append(open(t, "wb"))
+    for chunk_tuple in chunks:
+      for i, chunk in enumerate(chunk_tuple):
+        hashes[i].update(chunk)
+        sizes[i] += len(chunk)
+        files[i].write(chunk)
+  except BaseException:
+    for f in files:
+      f.close()
+    for t in targets:
+      remove_file(t)
+    raise
+  for f in files:
+    f.close()
+
+  written = []
+  for p, t, e, h, size in zip(paths, targets, existing, hashes, sizes):
+    if not e:
+      written.append(True)
+    elif os.path.getsize(p) == size and __get_file_hash(p) == h.digest():
+      os.remove(t)
+      written.append(False)
+    else:
+      os.replace(t, p)
+      written.append(True)
+  return written
+
+
+def write_archive(
+    path: str, archive_format: str,
+    members: Iterable[Tuple[str, Iterable[bytes]]]) -> Dict[str, dict]:
+  """ Stream members into a tar or zip archive
+
+  Every member is a name and the chunks of its content. Each member is added
+  to the archive as soon as it is complete. The archive is written to a
+  temporary file that replaces path at the end.
+  Returns the sha256 hash and the size of every member """
+
+  index = {}
+  temp_path = os.path.join(os.path.dirname(path),
+                           "." + os.path.basename(path) + ".tmp")
+  try:
+    if ARCHIVE_FORMATS[archive_format] is None:
+      with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, chunks in members:
+          info = zipfile.ZipInfo(name, time.localtime()[:6])
+          info.compress_type = zipfile.ZIP_DEFLATED
+          info.external_attr = 0o600 << 16
+          h = hashlib.sha256()
+          size = 0
+          with zf.open(info, "w") as f:
+            for chunk in chunks:
+              h.update(chunk)
+              size += len(chunk)
+              f.write(chunk)
+          index[name] = {"sha256": h.hexdigest(), "size": size}
+    else:
+      with tarfile.open(temp_path, ARCHIVE_FORMATS[archive_format]) as tf:
+        for name, chunks in members:
+          # The size of a tar member has to be known before its content
+          data = b"".join(chunks)
+          info = tarfile.TarInfo(name)
+          info.size = len(data)
+          info.mtime = int(time.time())
+          info.mode = 0o600
+          tf.addfile(info, io.BytesIO(data))
+          index[name] = {
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "size": len(data)
+          }
+    os.replace(temp_path, path)
+  except BaseException:
+    remove_file(temp_path)
+    raise
+  return index
+
+
+def read_archive(path: str, archive_format: str) -> Dict[str, bytes]:
+  """ Get the content of all members of an archive
+
+  A missing archive has no members. """
+
+  if not os.path.isfile(path):
+    return {}
+
+  if ARCHIVE_FORMATS[archive_format] is None:
+    with zipfile.ZipFile(path) as zf:
+      return {name: zf.read(name) for name in zf.namelist()}
+  with tarfile.open(path) as tf:
+    return {
+      m.name: tf.extractfile(m).read()
+      for m in tf.getmembers() if m.isfile()
+    }
+
+
+def __get_file_hash(path: str) -> bytes:
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(65536), b""):
+      h.update(chunk)
+  return h.digest()
+
+
+def remove_file(path: str) -> bool:
+  """ Remove a file if it exists
+
+  Returns if the file has been removed """
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    return False
+  return True
+
+
 def read_file(path: str) -> str:
   """ Get the content of a file """
   try:
@@ -48,8 +228,87 @@ def __clean_directory(path: str):
 
 
 def delete_directory(path: str):
-  """ Clears existing config files in a directory """
+  """ Clears existing config files in a directory
 
+  If path is a link to a staged directory, the link is removed as well. """
+
+  if os.path.islink(path):
+    target = os.path.realpath(path)
+    os.remove(path)
+    path = target
   if os.path.isdir(path):
     __clean_directory(path)
     os.rmdir(path)
+
+
+def stage_directory(path: str, file_names: list) -> str:
+  """ Create a new directory next to path to replace it with swap_directory
+
+  The files of file_names that exist in path are hard linked (or copied if
+  the file system does not support hard links) into the new directory.
+  Returns the path of the new directory """
+
+  parent, name = os.path.split(os.path.abspath(path))
+  staging_path = os.path.join(parent, f".{name}.{time.time_ns()}")
+  os.makedirs(staging_path)
+  for f in file_names:
+    if os.path.isfile(os.path.join(path, f)):
+      try:
+        os.link(os.path.join(path, f), os.path.join(staging_path, f))
+      except OSError:
+        shutil.copy2(os.path.join(path, f), os.path.join(staging_path, f))
+  return staging_path
+
+
+def sync_directory(path: str, file_names: list):
+  """ Flush the files of file_names and the directory itself to disk """
+
+  for f in file_names:
+    with open(os.path.join(path, f), "rb") as fp:
+      os.fsync(fp.fileno())
+  __sync_path(path)
+
+
+def swap_directory(staging_path: str, path: str):
+  """ Replace path with a directory created by stage_directory
+
+  path becomes a symbolic link to the staged directory, which is replaced
+  atomically, so readers always see a complete directory. Only the first swap
+  of a real directory has a short gap. If symbolic links are not available,
+  the directories are renamed. """
+
+  parent, name = os.path.split(os.path.abspath(path))
+  old_path = None
+  if os.path.islink(path):
+    old_path = os.path.realpath(path)
+  elif os.path.isdir(path):
+    old_path = os.path.join(parent, f".{name}.old")
+    delete_directory(old_path)
+    os.rename(path, old_path)
+
+  link_path = os.path.join(parent, f".{name}.link")
+  remove_file(link_path)
+  try:
+    os.symlink(os.path.basename(staging_path), link_path)
+    os.replace(link_path, path)
+  except (OSError, NotImplementedError):
+    os.rename(staging_path, path)
+  __sync_path(parent)
+
+  if old_path is not None and old_path != os.path.realpath(path):
+    delete_directory(old_path)
+
+
+def __sync_path(path: str):
+  """ Flush a directory entry to disk where the platform supports it """
+
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
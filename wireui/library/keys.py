@@ -1,44 +1,601 @@
-# wireguard.py
-# Get keys from wg executable
-# Author: Tim Schlottmannimport os
+# keys.py
+# Create private, public and preshared keys
+# Author: Tim Schlottmann
 
-import subprocess
+import asyncio
+import base64
 import collections
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import subprocess
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from .curve25519 import clamp
+from .curve25519 import x25519_base
+
+from .io_ import read_file
+from .io_ import write_file
 
 from .typedefs import Keys
+from .typedefs import PeerItems
+from .typedefs import Peers
 from .typedefs import WireguardNotFoundError
 
+# "python" creates the keys in-process, "wg" uses the wg executable and
+# "wg_batch" runs the wg executable from one long-lived shell session
+KEY_BACKENDS = ["python", "wg", "wg_batch"]
+
+# "peer" uses the psk of one of the two peers for a link, "link" derives an
+# individual psk for every link from the site secret
+PSK_MODES = ["peer", "link"]
+
+__key_backend = "python"
 __wg_exec = ""
+__wg_checked = False
+__wg_probe_cache_path = ""
+__async_concurrency = 16
+__async_semaphores = weakref.WeakKeyDictionary()
+__async_probe_locks = weakref.WeakKeyDictionary()
+
+
+class KeyPoolStats(NamedTuple):
+  hits: int
+  misses: int
+  size: int
+  # Failed attempts of the background thread to create keys
+  errors: int
+  last_error: Optional[Exception]
+
+
+class KeyPool():
+  """ Pool of keys that is filled by a background thread
+
+  As soon as the number of keys in the pool drops to low_watermark, the
+  pool is refilled up to high_watermark. If keys cannot be created, the
+  background thread retries with an increasing delay (up to
+  MAX_RETRY_DELAY seconds) and the errors are counted in the stats. """
+
+  MIN_RETRY_DELAY = 0.1
+  MAX_RETRY_DELAY = 30.0
+
+  def __init__(self, low_watermark: int, high_watermark: int,
+               create_keys: Callable[[], Keys]):
+    if low_watermark < 0 or high_watermark <= low_watermark:
+      raise ValueError(
+        f"Watermarks have to satisfy 0 <= low_watermark < high_watermark. Got {low_watermark} and {high_watermark}"
+      )
+
+    self.__low_watermark = low_watermark
+    self.__high_watermark = high_watermark
+    self.__create_keys = create_keys
+    self.__keys = collections.deque()
+    self.__condition = threading.Condition()
+    self.__hits = 0
+    self.__misses = 0
+    self.__errors = 0
+    self.__last_error: Optional[Exception] = None
+    self.__closed = False
+
+    self.__thread = threading.Thread(target=self.__fill,
+                                     name="wireui-key-pool",
+                                     daemon=True)
+    self.__thread.start()
+
+  @property
+  def stats(self) -> KeyPoolStats:
+    with self.__condition:
+      return KeyPoolStats(hits=self.__hits,
+                          misses=self.__misses,
+                          size=len(self.__keys),
+                          errors=self.__errors,
+                          last_error=self.__last_error)
+
+  def get(self) -> Keys:
+    """ Get keys from the pool or create them if the pool is empty """
+
+    with self.__condition:
+      if self.__keys:
+        self.__hits += 1
+        keys = self.__keys.popleft()
+        if len(self.__keys) <= self.__low_watermark:
+          self.__condition.notify()
+        return keys
+      self.__misses += 1
+      self.__condition.notify()
+
+    return self.__create_keys()
+
+  def close(self):
+    """ Stop the background thread """
+
+    with self.__condition:
+      self.__closed = True
+      self.__condition.notify()
+
+  def __fill(self):
+    while True:
+      with self.__condition:
+        while not self.__closed and len(
+            self.__keys) > self.__low_watermark:
+          self.__condition.wait()
+        if self.__closed:
+          return
+
+      # Keys are created without holding the lock, so get() never waits for them
+      retry_delay = self.MIN_RETRY_DELAY
+      while True:
+        try:
+          keys = self.__create_keys()
+        except Exception as e:
+          # get() raises the error itself once the pool is empty
+          with self.__condition:
+            self.__errors += 1
+            self.__last_error = e
+            self.__condition.wait_for(lambda: self.__closed, retry_delay)
+            if self.__closed:
+              return
+          retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
+          continue
+        retry_delay = self.MIN_RETRY_DELAY
+        with self.__condition:
+          if self.__closed:
+            return
+          self.__keys.append(keys)
+          if len(self.__keys) >= self.__high_watermark:
+            break
+
+
+class WgSession():
+  """ Long-lived shell session that creates keys with the wg executable
+
+  The shell reads the number of requested keys from stdin and writes one line
+  "privkey pubkey psk" per key to stdout. """
+
+  SCRIPT = """
+command -v "$1" >/dev/null 2>&1 || { echo "not_found"; exit 127; }
+while read -r n; do
+  i=0
+  while [ "$i" -lt "$n" ]; do
+    k=$("$1" genkey) && p=$(printf '%s\\n' "$k" | "$1" pubkey) && s=$("$1" genpsk) || { echo "error"; exit 1; }
+    printf '%s %s %s\\n' "$k" "$p" "$s"
+    i=$((i + 1))
+  done
+done
+"""
+
+  def __init__(self, wg_exec: str):
+    self.__wg_exec = wg_exec
+    self.__lock = threading.RLock()
+    self.__process = subprocess.Popen(["sh", "-c", self.SCRIPT, "sh", wg_exec],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      encoding="utf-8")
+
+  @property
+  def wg_exec(self) -> str:
+    return self.__wg_exec
+
+  @property
+  def alive(self) -> bool:
+    return self.__process.poll() is None
+
+  def create_keys(self, n: int) -> List[Keys]:
+    """ Create n sets of keys """
+
+    with self.__lock:
+      try:
+        self.__process.stdin.write(f"{n}\n")
+        self.__process.stdin.flush()
+      except (BrokenPipeError, ValueError):
+        pass
+
+      keys = []
+      for _ in range(n):
+        line = self.__process.stdout.readline().split()
+        if len(line) != 3:
+          self.close()
+          raise WireguardNotFoundError(
+            "Wireguard not found. Please install it and/or make shure it is available via $PATH"
+          )
+        keys.append(Keys({
+          "privkey": line[0],
+          "pubkey": line[1],
+          "psk": line[2],
+        }))
+      return keys
+
+  def close(self):
+    """ End the shell session """
+
+    with self.__lock:
+      if self.__process.poll() is None:
+        self.__process.stdin.close()
+        self.__process.wait()
+      self.__process.stdout.close()
+
+
+__key_pool: Optional[KeyPool] = None
+__wg_session: Optional[WgSession] = None
+# The session is used by the key pool thread and the callers of get_keys
+__wg_session_lock = threading.Lock()
+
+
+def __reset_wg_session():
+  """ A forked worker process starts its own session with a new lock """
+
+  global __wg_session
+  global __wg_session_lock
+  __wg_session = None
+  __wg_session_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=__reset_wg_session)
 
 
 def get_keys() -> Keys:
+  """ Get private, public and preshared key
+
+  If a key pool is set, the keys are taken from the pool. """
+
+  if __key_pool is not None:
+    return __key_pool.get()
+  return create_keys()
+
+
+def create_keys() -> Keys:
   """ Creates private, public and preshared key """
 
+  if __key_backend != "python":
+    check_wireguard()
+
+  if __key_backend == "wg_batch" and shutil.which("sh"):
+    return __get_wg_session().create_keys(1)[0]
+
+  if __key_backend in ["wg", "wg_batch"]:
+    privkey = __get_privkey_wg()
+    return Keys({
+      "privkey": privkey,
+      "pubkey": __get_pubkey_wg(privkey),
+      "psk": __get_psk_wg(),
+    })
+
   privkey = __get_privkey()
   return Keys({
     "privkey": privkey,
-    "pubkey": __get_pubkey(privkey),
-    "psk": __get_psk(),
+    "pubkey": get_pubkey(privkey),
+    "psk": get_psk(),
   })
 
+
+async def get_keys_async(timeout: Optional[float] = None) -> Keys:
+  """ Creates private, public and preshared key without blocking the event loop
+
+  With the "python" key backend the keys are created in the default executor
+  of the event loop (a thread), because the curve25519 computation takes some
+  milliseconds. With a wg key backend the wg processes (including the check of
+  the executable) are run with asyncio. The number of concurrently created
+  keys is limited by set_async_concurrency and every wg call is cancelled
+  after timeout seconds. """
+
+  if __key_backend == "python":
+    async with __get_async_semaphore():
+      return await asyncio.get_running_loop().run_in_executor(
+        None, create_keys)
+
+  await __check_wireguard_async(timeout)
+  async with __get_async_semaphore():
+    privkey = await __run_async([__wg_exec, "genkey"], timeout=timeout)
+    pubkey, psk = await asyncio.gather(
+      __run_async([__wg_exec, "pubkey"],
+                  input=privkey.encode("utf-8"),
+                  timeout=timeout),
+      __run_async([__wg_exec, "genpsk"], timeout=timeout),
+    )
+  return Keys({
+    "privkey": privkey,
+    "pubkey": pubkey,
+    "psk": psk,
+  })
+
+
+def create_keys_batch(n: int) -> List[Keys]:
+  """ Create n sets of keys
+
+  With key backend "wg_batch" all keys are created by one shell session. """
+
+  if __key_backend != "python":
+    check_wireguard()
+
+  if __key_backend == "wg_batch" and shutil.which("sh"):
+    return __get_wg_session().create_keys(n)
+
+  return [create_keys() for _ in range(n)]
+
+
+def create_keys_parallel(n: int, workers: int) -> List[Keys]:
+  """ Create n sets of keys with a pool of worker processes """
+
+  workers = min(workers, n)
+  if workers <= 1:
+    return create_keys_batch(n)
+
+  chunks = [n // workers + (1 if i < n % workers else 0) for i in range(workers)]
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    results = executor.map(__create_keys_chunk, chunks, repeat(__key_backend),
+                           repeat(__wg_exec))
+    return [keys for chunk in results for keys in chunk]
+
+
+def get_pubkey(privkey: str) -> str:
+  """ Derive the public key from a private key """
+
+  return __encode(x25519_base(base64.b64decode(privkey)))
+
+
+def get_psk() -> str:
+  """ Create a preshared key """
+
+  return __encode(os.urandom(32))
+
+
+def derive_psk(secret: bytes, peer_1: Tuple[str, str],
+               peer_2: Tuple[str, str]) -> str:
+  """ Derive the preshared key of the link between two peers
+
+  peer_1 and peer_2 are the name and the stored psk of the two peers. The key
+  is derived with HKDF-SHA256 (RFC 5869) from the site secret and the peers
+  sorted by name, so both ends of a link get the same key. Rekeying one of the
+  peers changes the key of all of its links. """
+
+  peers = sorted([peer_1, peer_2])
+  info = b"\x00".join([
+    b"wireui psk", peers[0][0].encode("utf-8"), peers[1][0].encode("utf-8"),
+    peers[0][1].encode("utf-8"), peers[1][1].encode("utf-8")
+  ])
+  prk = hmac.new(b"\x00" * 32, secret, hashlib.sha256).digest()
+  return __encode(hmac.new(prk, info + b"\x01", hashlib.sha256).digest())
+
+
+class LinkPsks(dict):
+  """ Preshared keys of the links of a site
+
+  The keys are derived on first use and cached afterwards. """
+  def __init__(self, secret: str, peers: Peers):
+    super().__init__()
+    self.__secret = base64.b64decode(secret)
+    self.__peers = peers
+
+  def get_psk(self, peer_1: str, peer_2: str) -> str:
+    link = (peer_1, peer_2) if peer_1 < peer_2 else (peer_2, peer_1)
+    if link not in self:
+      self[link] = derive_psk(
+        self.__secret, (link[0], self.__peers[link[0]]["keys"]["psk"]),
+        (link[1], self.__peers[link[1]]["keys"]["psk"]))
+    return self[link]
+
+
+def is_valid_key(key: str) -> bool:
+  """ Check if key is a base64 encoded 32 byte key """
+
+  if len(key) != 44:
+    return False
+  try:
+    return len(base64.b64decode(key, validate=True)) == 32
+  except ValueError:
+    return False
+
+
+def is_own_key_peer(peer: PeerItems) -> bool:
+  """ Check if a peer brings its own key (there is no private key) """
+
+  return "privkey" not in peer["keys"]
+
+
+def set_key_backend(key_backend: str):
+  if key_backend not in KEY_BACKENDS:
+    raise ValueError(
+      f"Unknown key backend {key_backend}. Possible values are {KEY_BACKENDS}")
+
+  global __key_backend
+  __key_backend = key_backend
+
+
+def set_async_concurrency(concurrency: int):
+  """ Set the maximum number of keys get_keys_async creates at the same time """
+
+  if concurrency < 1:
+    raise ValueError(f"concurrency has to be at least 1. Got {concurrency}")
+
+  global __async_concurrency
+  __async_concurrency = concurrency
+  __async_semaphores.clear()
+
+
+def set_key_pool(low_watermark: int, high_watermark: int):
+  """ Set the watermarks of the key pool
+
+  A high_watermark of 0 disables the key pool. """
+
+  global __key_pool
+  if __key_pool is not None:
+    __key_pool.close()
+    __key_pool = None
+  if high_watermark:
+    __key_pool = KeyPool(low_watermark=low_watermark,
+                         high_watermark=high_watermark,
+                         create_keys=create_keys)
+
+
+def get_key_pool_stats() -> Optional[KeyPoolStats]:
+  """ Get hit and miss counters of the key pool """
+
+  if __key_pool is None:
+    return None
+  return __key_pool.stats
+
+
 def set_wg_exec(wg_exec: str):
   global __wg_exec
+  global __wg_checked
   __wg_exec = wg_exec
+  __wg_checked = False
+
+
+def set_wg_probe_cache_path(path: str):
+  """ Set the file the result of check_wireguard is cached in
+
+  An empty path disables the cache. """
+
+  global __wg_probe_cache_path
+  __wg_probe_cache_path = path
+
+
+def check_wireguard():
+  """ Check if the wg executable is available and works
+
+  The check is done once per process. A successful check is cached on disk,
+  keyed by the path, the mtime and the size of the executable. So as long as
+  the executable is unchanged, no process is spawned. """
+
+  global __wg_checked
+  if __wg_checked:
+    return
+
+  fingerprint = __get_wg_fingerprint()
+  if not __is_wg_probe_cached(fingerprint):
+    if not is_valid_key(__get_psk_wg()):
+      raise WireguardNotFoundError(
+        f"{__wg_exec} does not seem to be a working wireguard executable")
+    __cache_wg_probe(fingerprint)
+  __wg_checked = True
+
+
+async def __check_wireguard_async(timeout: Optional[float] = None):
+  """ check_wireguard without blocking the event loop
+
+  The probe is run once per event loop at a time with asyncio and is
+  cancelled after timeout seconds. """
+
+  global __wg_checked
+  if __wg_checked:
+    return
+
+  loop = asyncio.get_running_loop()
+  if loop not in __async_probe_locks:
+    __async_probe_locks[loop] = asyncio.Lock()
+  async with __async_probe_locks[loop]:
+    if __wg_checked:
+      return
+    fingerprint = __get_wg_fingerprint()
+    if not __is_wg_probe_cached(fingerprint):
+      psk = await __run_async([__wg_exec, "genpsk"], timeout=timeout)
+      if not is_valid_key(psk):
+        raise WireguardNotFoundError(
+          f"{__wg_exec} does not seem to be a working wireguard executable")
+      __cache_wg_probe(fingerprint)
+    __wg_checked = True
+
+
+def __get_wg_fingerprint() -> dict:
+  """ Get path, mtime and size of the wg executable """
+
+  path = shutil.which(__wg_exec)
+  if path is None:
+    raise WireguardNotFoundError(
+      "Wireguard not found. Please install it and/or make shure it is available via $PATH"
+    )
+  stat = os.stat(path)
+  return {
+    "wg_exec": os.path.abspath(path),
+    "mtime": stat.st_mtime_ns,
+    "size": stat.st_size,
+  }
+
+
+def __is_wg_probe_cached(fingerprint: dict) -> bool:
+  """ Check if a wg executable with the fingerprint worked before """
+
+  if not __wg_probe_cache_path:
+    return False
+  try:
+    cached = json.loads(read_file(__wg_probe_cache_path) or "{}")
+  except json.JSONDecodeError:
+    cached = {}
+  return cached == fingerprint
+
+
+def __cache_wg_probe(fingerprint: dict):
+  """ Store the fingerprint of a working wg executable """
+
+  if __wg_probe_cache_path:
+    write_file(__wg_probe_cache_path, json.dumps(fingerprint))
+
+
+def __create_keys_chunk(n: int, key_backend: str, wg_exec: str) -> List[Keys]:
+  """ Create keys in a worker process """
+
+  set_key_backend(key_backend)
+  set_wg_exec(wg_exec)
+  return create_keys_batch(n)
+
+
+def __get_wg_session() -> WgSession:
+  """ Get the shell session for the current wg executable """
+
+  global __wg_session
+  with __wg_session_lock:
+    if (__wg_session is None or __wg_session.wg_exec != __wg_exec
+        or not __wg_session.alive):
+      if __wg_session is not None:
+        __wg_session.close()
+      __wg_session = WgSession(__wg_exec)
+    return __wg_session
+
+
+def __get_async_semaphore() -> asyncio.Semaphore:
+  """ Get the semaphore of the running event loop """
+
+  loop = asyncio.get_running_loop()
+  if loop not in __async_semaphores:
+    __async_semaphores[loop] = asyncio.Semaphore(__async_concurrency)
+  return __async_semaphores[loop]
 
 
 def __get_privkey() -> str:
+  """ Create a private key in the same format as 'wg genkey' """
+
+  return __encode(clamp(os.urandom(32)))
+
+
+def __encode(b: bytes) -> str:
+  return base64.b64encode(b).decode("ascii")
+
+
+def __get_privkey_wg() -> str:
   """ Get a private key from wg """
 
   return __run([__wg_exec, "genkey"])
 
 
-def __get_pubkey(private: str) -> str:
+def __get_pubkey_wg(private: str) -> str:
   """ Get a public key from wg """
 
   return __run([__wg_exec, "pubkey"], input=private.encode("utf-8"))
 
 
-def __get_psk() -> str:
+def __get_psk_wg() -> str:
   """ Get a presharedkey from wg """
 
   return __run([__wg_exec, "genpsk"])
@@ -54,3 +611,28 @@ def __run(*args, **kwargs) -> str:
     raise WireguardNotFoundError(
       "Wireguard not found. Please install it and/or make shure it is available via $PATH"
     )
+
+
+async def __run_async(args: list,
+                      input: Optional[bytes] = None,
+                      timeout: Optional[float] = None) -> str:
+  """ Run a program on the OS with asyncio and collect output """
+
+  try:
+    process = await asyncio.create_subprocess_exec(
+      *args,
+      stdin=subprocess.PIPE if input is not None else None,
+      stdout=subprocess.PIPE)
+  except FileNotFoundError:
+    raise WireguardNotFoundError(
+      "Wireguard not found. Please install it and/or make shure it is available via $PATH"
+    )
+
+  # The process is killed on timeout and if the calling task is cancelled
+  try:
+    stdout, _ = await asyncio.wait_for(process.communicate(input), timeout)
+  except (asyncio.TimeoutError, asyncio.CancelledError):
+    process.kill()
+    await process.wait()
+    raise
+  return stdout.decode("utf-8").strip()
@@ -0,0 +1,68 @@
+import unittest
+from typing import List
+
+from .addresses import AddressAllocations
+from .addresses import AddressAllocator
+from .typedefs import AddressPoolExhaustedError
+
+NETWORKS = ["10.0.0.0/29", "fd00::/64"]
+
+
+def get_address_allocations(ip_networks: List[str],
+                            peer_names: List[str]) -> AddressAllocations:
+  """ Allocate addresses for peers in the order of peer_names """
+
+  allocations = AddressAllocations()
+  allocator = AddressAllocator(ip_networks, allocations)
+  for p in peer_names:
+    allocator.allocate(p)
+  return allocations
+
+
+class TestAddressAllocator(unittest.TestCase):
+  def test_allocate(self):
+    allocations = get_address_allocations(NETWORKS, ["a", "b", "c"])
+    allocator = AddressAllocator(NETWORKS, allocations)
+    self.assertEqual({
+      "10.0.0.0/29": "10.0.0.3",
+      "fd00::/64": "fd00::3"
+    }, allocator.get_addresses("c"))
+
+    # Deleting a peer does not change the addresses of the other peers
+    allocator.free("b")
+    self.assertEqual("10.0.0.3", allocator.get_addresses("c")["10.0.0.0/29"])
+    self.assertEqual({}, allocator.get_addresses("b"))
+
+    # Released addresses are used first
+    self.assertEqual("10.0.0.2", allocator.allocate("d")["10.0.0.0/29"])
+    self.assertEqual("10.0.0.4", allocator.allocate("e")["10.0.0.0/29"])
+    self.assertEqual("10.0.0.4", allocator.allocate("e")["10.0.0.0/29"])
+
+  def test_reserve(self):
+    allocations = get_address_allocations(NETWORKS, ["a"])
+    allocator = AddressAllocator(NETWORKS, allocations)
+    allocator.reserve("10.0.0.2", "10.0.0.3")
+    allocator.reserve("10.0.0.4", "10.0.0.4")
+    self.assertEqual("10.0.0.5", allocator.allocate("b")["10.0.0.0/29"])
+    self.assertEqual("10.0.0.6", allocator.allocate("c")["10.0.0.0/29"])
+    self.assertRaises(AddressPoolExhaustedError, allocator.allocate, "d")
+
+    self.assertRaises(ValueError, allocator.reserve, "10.0.0.1", "10.0.0.1")
+    self.assertRaises(ValueError, allocator.reserve, "10.0.1.1", "10.0.1.2")
+
+  def test_networks(self):
+    allocations = get_address_allocations(NETWORKS, ["a", "b"])
+    allocator = AddressAllocator(["10.0.0.0/29", "10.1.0.0/30"], allocations)
+    self.assertEqual(["10.0.0.0/29", "10.1.0.0/30"], list(allocations))
+    self.assertEqual({"10.0.0.0/29": "10.0.0.1"}, allocator.get_addresses("a"))
+    self.assertEqual({
+      "10.0.0.0/29": "10.0.0.1",
+      "10.1.0.0/30": "10.1.0.1"
+    }, allocator.allocate("a"))
+
+    allocator.free_unknown(["a"])
+    self.assertEqual({}, allocator.get_addresses("b"))
+
+
+if __name__ == "__main__":
+  unittest.main()
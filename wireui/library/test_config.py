@@ -0,0 +1,378 @@
+import base64
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from .addresses import AddressAllocator
+from .config import aggregate_allowed_ips
+from .config import clear_section_cache
+from .config import delete_config
+from .config import get_adjacency
+from .config import get_section_cache_stats
+from .config import read_configs
+from .config import render_nftables_ruleset
+from .config import render_peer
+from .config import render_site
+from .config import strip_wg_quick
+from .config import write_config
+from .config import write_configs
+from .keys import create_keys_batch
+from .keys import derive_psk
+
+
+def get_site(n: int) -> dict:
+  """ Get a site with a hub and n roadwarriors """
+
+  keys = create_keys_batch(n + 1)
+  peers = {
+    "hub": {
+      "keys": keys[0],
+      "additional_allowed_ips": ["192.168.1.0/24"],
+      "outgoing_connected_peers": [],
+      "main_peer": "None",
+      "ingoing_connected_peers": [f"peer{i}" for i in range(n)],
+      "endpoint": "hub.example.com",
+      "port": 51820,
+      "dns": [],
+      "persistent_keep_alive": 25,
+      "redirect_all_traffic": {
+        "ipv4": False,
+        "ipv6": False
+      },
+      "post_up": "",
+      "post_down": "",
+      "ipv6_routing_fix": False,
+    }
+  }
+  for i in range(n):
+    peers[f"peer{i}"] = {
+      "keys": keys[i + 1],
+      "additional_allowed_ips": [],
+      "outgoing_connected_peers": ["hub"],
+      "main_peer": "hub",
+      "ingoing_connected_peers": [],
+      "endpoint": "",
+      "port": 0,
+      "dns": ["1.1.1.1"],
+      "persistent_keep_alive": 25,
+      "redirect_all_traffic": {
+        "ipv4": i % 2 == 0,
+        "ipv6": i % 3 == 0
+      },
+      "post_up": "",
+      "post_down": "",
+      "ipv6_routing_fix": i % 4 == 0,
+    }
+  allocations = {}
+  allocator = AddressAllocator(["10.0.0.0/24", "fd00::/64"], allocations)
+  for p in peers:
+    allocator.allocate(p)
+  return {
+    "config_version": "0.1.5",
+    "psk_mode": "peer",
+    "psk_secret": keys[0]["psk"],
+    "ip_networks": ["10.0.0.0/24", "fd00::/64"],
+    "address_allocations": allocations,
+    "dns": ["1.1.1.1"],
+    "peers": peers,
+  }
+
+
+class TestWriteConfig(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def read_configs(self, path: str) -> dict:
+    configs = {}
+    for f in os.listdir(path):
+      with open(os.path.join(path, f), "rb") as fp:
+        configs[f] = fp.read()
+    return configs
+
+  def test_incremental(self):
+    site = get_site(4)
+    path = os.path.join(self.directory, "site")
+    r = write_config(site, path)
+    self.assertEqual(5, len(r.written))
+
+    r = write_config(site, path)
+    self.assertEqual(([], 5, []), (r.written, len(r.unchanged), r.removed))
+
+    site["peers"]["peer1"]["post_up"] = "echo up"
+    del site["peers"]["peer3"]
+    site["peers"]["hub"]["ingoing_connected_peers"].remove("peer3")
+    r = write_config(site, path)
+    self.assertEqual([os.path.join(path, f"wg_{p}.conf") for p in ["hub", "peer1"]],
+                     r.written)
+    self.assertEqual([os.path.join(path, "wg_peer3.conf")], r.removed)
+
+  def test_parallel(self):
+    site = get_site(9)
+    write_config(site, os.path.join(self.directory, "serial"))
+    for workers in [2, 4]:
+      path = os.path.join(self.directory, f"parallel{workers}")
+      write_config(site, path, workers)
+      self.assertEqual(
+        self.read_configs(os.path.join(self.directory, "serial")),
+        self.read_configs(path))
+
+  def test_render(self):
+    site = get_site(4)
+    write_config(site, self.directory)
+    configs = render_site(site)
+    adjacency = get_adjacency(site["peers"])
+    for p in site["peers"]:
+      with open(os.path.join(self.directory, f"wg_{p}.conf"), "rb") as f:
+        self.assertEqual(f.read(), configs[p])
+      self.assertEqual(configs[p], render_peer(site, p, adjacency))
+
+  def test_link_psks(self):
+    site = get_site(3)
+    site["psk_mode"] = "link"
+    site["peers"]["peer0"]["ingoing_connected_peers"] = ["peer1"]
+    site["peers"]["peer1"]["outgoing_connected_peers"].append("peer0")
+    configs = render_site(site)
+
+    secret = base64.b64decode(site["psk_secret"])
+    for p1, p2 in [("hub", "peer0"), ("hub", "peer2"), ("peer0", "peer1")]:
+      psk = derive_psk(secret, (p1, site["peers"][p1]["keys"]["psk"]),
+                       (p2, site["peers"][p2]["keys"]["psk"])).encode("utf-8")
+      # Both ends of a link use the same psk
+      self.assertIn(b"PresharedKey = " + psk, configs[p1])
+      self.assertIn(b"PresharedKey = " + psk, configs[p2])
+    self.assertNotIn(site["peers"]["hub"]["keys"]["psk"].encode("utf-8"),
+                     configs["peer0"])
+
+  def test_syncconf(self):
+    site = get_site(4)
+    site["peers"]["hub"]["post_up"] = "iptables -A FORWARD"
+    r = write_config(site, self.directory, syncconf=True)
+    self.assertEqual(10, len(r.written))
+
+    configs = self.read_configs(self.directory)
+    setconf = configs["wg_hub.setconf"].decode("utf-8")
+    self.assertIn("ListenPort = 51820\n", setconf)
+    self.assertIn("PrivateKey = ", setconf)
+    for key in ["Address", "DNS", "PostUp", "PostDown"]:
+      self.assertNotIn(key, setconf)
+    self.assertEqual(configs["wg_hub.conf"].count(b"[Peer]"),
+                     setconf.count("[Peer]"))
+    self.assertEqual(strip_wg_quick(configs["wg_peer0.conf"]),
+                     configs["wg_peer0.setconf"])
+    self.assertEqual(configs["wg_peer0.setconf"],
+                     render_peer(site, "peer0", syncconf=True))
+
+    r = write_config(site, self.directory)
+    self.assertEqual(5, len(r.removed))
+
+  def test_nftables(self):
+    site = get_site(4)
+    r = write_config(site, self.directory, nftables_path="/etc/wireguard")
+    self.assertEqual(10, len(r.written))
+
+    configs = self.read_configs(self.directory)
+    self.assertEqual(render_nftables_ruleset(site, "hub"),
+                     configs["wg_hub.nft"])
+    self.assertIn(b"PostUp = nft -f /etc/wireguard/wg_peer1.nft; \n",
+                  configs["wg_peer1.conf"])
+    self.assertIn(b"PostDown = nft delete table inet wireui_wg_peer1; \n",
+                  configs["wg_peer1.conf"])
+    # peer0 and peer2 redirect all ipv4 traffic through the hub
+    self.assertIn(b"set gateway_ipv4 {\n    type ipv4_addr\n"
+                  b"    flags interval\n    elements = { 10.0.0.2/32, "
+                  b"10.0.0.4/32 }\n", configs["wg_hub.nft"])
+
+    # The ruleset of the hub changes with the gateway peers
+    site["peers"]["peer2"]["redirect_all_traffic"]["ipv4"] = False
+    r = write_config(site, self.directory, nftables_path="/etc/wireguard")
+    self.assertEqual([
+      os.path.join(self.directory, f) for f in ["wg_hub.nft", "wg_peer2.conf"]
+    ], r.written)
+
+    r = write_config(site, self.directory)
+    self.assertEqual(5, len(r.removed))
+
+  @unittest.skipUnless(os.name == "posix", "requires symbolic links")
+  def test_staged_nftables(self):
+    site = get_site(4)
+    path = os.path.join(self.directory, "site")
+    write_config(site, path, output_mode="staged", nftables_path="/etc/wg")
+    with open(os.path.join(path, "wg_hub.nft"), "rb") as f:
+      old_ruleset = f.read()
+
+    # An open file of the live generation keeps its content
+    with open(os.path.join(path, "wg_hub.nft"), "rb") as f:
+      site["peers"]["peer2"]["redirect_all_traffic"]["ipv4"] = False
+      r = write_config(site,
+                       path,
+                       output_mode="staged",
+                       nftables_path="/etc/wg")
+      self.assertIn(os.path.join(path, "wg_hub.nft"), r.written)
+      self.assertEqual(old_ruleset, f.read())
+    self.assertEqual(render_nftables_ruleset(site, "hub"),
+                     self.read_configs(path)["wg_hub.nft"])
+    self.assertNotEqual(old_ruleset, self.read_configs(path)["wg_hub.nft"])
+
+  @unittest.skipUnless(os.name == "posix", "requires symbolic links")
+  def test_staged(self):
+    site = get_site(4)
+    path = os.path.join(self.directory, "site")
+    write_config(site, path)
+    configs = self.read_configs(path)
+
+    r = write_config(site, path, output_mode="staged")
+    self.assertEqual(([], 5), (r.written, len(r.unchanged)))
+    self.assertTrue(os.path.islink(path))
+    self.assertEqual(configs, self.read_configs(path))
+
+    del site["peers"]["peer3"]
+    site["peers"]["hub"]["ingoing_connected_peers"].remove("peer3")
+    r = write_config(site, path, output_mode="staged")
+    self.assertEqual([os.path.join(path, "wg_hub.conf")], r.written)
+    self.assertEqual([os.path.join(path, "wg_peer3.conf")], r.removed)
+    self.assertNotIn("wg_peer3.conf", self.read_configs(path))
+    self.assertEqual(["site", os.path.basename(os.path.realpath(path))],
+                     sorted(os.listdir(self.directory), reverse=True))
+
+    self.assertRaises(ValueError, write_config, site, path, 1, "unknown")
+
+    # A failed write removes the staged directory
+    configs = self.read_configs(path)
+    site["peers"]["hub"]["port"] = 1234
+    site["peers"]["peer1"]["keys"]["privkey"] = None
+    self.assertRaises(TypeError, write_config, site, path, 1, "staged")
+    self.assertEqual(configs, self.read_configs(path))
+    self.assertEqual(["site", os.path.basename(os.path.realpath(path))],
+                     sorted(os.listdir(self.directory), reverse=True))
+
+  def test_archive(self):
+    site = get_site(4)
+    write_config(site, os.path.join(self.directory, "site"))
+    configs = self.read_configs(os.path.join(self.directory, "site"))
+    del configs[".wireui_manifest.json"]
+
+    for archive_format in ["tar", "tar.gz", "tar.xz", "zip"]:
+      path = os.path.join(self.directory, "archive")
+      archive_path = f"{path}.{archive_format}"
+      r = write_config(site, path, output_mode=archive_format)
+      self.assertEqual(5, len(r.written))
+      if archive_format == "zip":
+        with zipfile.ZipFile(archive_path) as zf:
+          members = {n: zf.read(n) for n in zf.namelist()}
+      else:
+        with tarfile.open(archive_path) as tf:
+          members = {n: tf.extractfile(n).read() for n in tf.getnames()}
+      self.assertEqual(configs, members)
+
+      with open(archive_path + ".index.json") as f:
+        index = json.load(f)
+      self.assertEqual(len(configs["wg_hub.conf"]),
+                       index["members"]["wg_hub.conf"]["size"])
+
+      r = write_config(site, path, output_mode=archive_format)
+      self.assertEqual(([], 5), (r.written, len(r.unchanged)))
+
+      delete_config("archive", path)
+      self.assertFalse(os.path.exists(archive_path))
+      self.assertFalse(os.path.exists(archive_path + ".index.json"))
+
+  def test_aggregate(self):
+    self.assertEqual(["10.0.0.0/23", "fd00::/63"],
+                     aggregate_allowed_ips([
+                       "10.0.1.0/24", "fd00::/64", "10.0.0.0/24",
+                       "10.0.0.5/32", "fd00:0:0:1::/64"
+                     ]))
+    self.assertEqual(["0.0.0.0/0", "fd00::1/128", "host"],
+                     aggregate_allowed_ips(
+                       ["0.0.0.0/0", "10.0.0.2/32", "fd00::1/128", "host"]))
+    # Without savings the order is kept
+    self.assertEqual(["10.0.0.2/32", "10.0.0.1/32"],
+                     aggregate_allowed_ips(["10.0.0.2/32", "10.0.0.1/32"]))
+
+    site = get_site(4)
+    site["peers"]["hub"]["additional_allowed_ips"] = [
+      "192.168.0.0/24", "192.168.1.0/24", "192.168.1.128/25"
+    ]
+    r = write_config(site, self.directory)
+    self.assertEqual({}, r.saved_prefixes)
+    r = write_config(site, self.directory, aggregate=True)
+    # peer0 redirects all ipv4 traffic, so 0.0.0.0/0 covers all prefixes
+    self.assertEqual({"peer0": 3, "peer1": 2, "peer2": 3, "peer3": 2},
+                     r.saved_prefixes)
+    self.assertNotIn(os.path.join(self.directory, "wg_hub.conf"), r.written)
+    with open(os.path.join(self.directory, "wg_peer1.conf")) as f:
+      self.assertIn("AllowedIPs = 10.0.0.1/32, 192.168.0.0/23, fd00::1/128\n",
+                    f.read())
+
+    # The counts of unchanged files are taken from the manifest
+    manifest_path = os.path.join(self.directory, ".wireui_manifest.json")
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+    manifest["saved_prefixes"]["peer0"] = 7
+    with open(manifest_path, "w") as f:
+      json.dump(manifest, f)
+    r = write_config(site, self.directory, aggregate=True)
+    self.assertEqual([], r.written)
+    self.assertEqual(7, r.saved_prefixes["peer0"])
+    # Changed inputs are counted again
+    site["peers"]["peer0"]["port"] = 1234
+    r = write_config(site, self.directory, aggregate=True)
+    self.assertEqual(3, r.saved_prefixes["peer0"])
+
+    # A manifest without counts
+    with open(manifest_path, "w") as f:
+      json.dump(manifest["files"], f)
+    r = write_config(site, self.directory, aggregate=True)
+    self.assertEqual({"peer0": 3, "peer1": 2, "peer2": 3, "peer3": 2},
+                     r.saved_prefixes)
+
+  def test_section_cache(self):
+    site = get_site(4)
+    clear_section_cache()
+    configs = render_site(site)
+    self.assertEqual((0, 8), get_section_cache_stats()[:2])
+    self.assertEqual(configs, render_site(site))
+    self.assertEqual((8, 8, 8), tuple(get_section_cache_stats()))
+
+    # Changed inputs are rendered again
+    site["peers"]["hub"]["port"] = 1234
+    site["peers"]["peer1"]["additional_allowed_ips"] = ["192.168.2.0/24"]
+    new_configs = render_site(site)
+    self.assertIn(b"Endpoint = hub.example.com:1234\n", new_configs["peer0"])
+    self.assertIn(b"10.0.0.3/32, fd00::3/128, 192.168.2.0/24\n",
+                  new_configs["hub"])
+    self.assertEqual(configs["peer0"].split(b"[Peer]")[0],
+                     new_configs["peer0"].split(b"[Peer]")[0])
+
+  def test_read_configs(self):
+    site = get_site(4)
+    path = os.path.join(self.directory, "site")
+    self.assertEqual({}, read_configs(path))
+    for output_mode in ["incremental", "zip", "tar.gz"]:
+      write_config(site, path, output_mode=output_mode)
+      self.assertEqual(render_site(site), read_configs(path, output_mode))
+
+  def test_write_configs(self):
+    sites = {"a": get_site(2), "b": get_site(3), "broken": get_site(1)}
+    del sites["broken"]["address_allocations"]
+    for workers in [1, 2]:
+      results = write_configs(sites, self.directory, workers)
+      self.assertEqual(["a", "b", "broken"], list(results))
+      self.assertIsNone(results["a"].error)
+      self.assertEqual(4, len(results["b"].result.written) +
+                       len(results["b"].result.unchanged))
+      self.assertIsInstance(results["broken"].error, KeyError)
+      self.assertIsNone(results["broken"].result)
+    self.assertTrue(
+      os.path.isfile(os.path.join(self.directory, "b", "wg_hub.conf")))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+from .diff import diff_config
+from .diff import diff_configs
+from .diff import split_config
+from .diff import CONFIG_DIFF_STATUS
+
+OLD = b"""[Interface]
+PrivateKey = private
+Address = 10.0.0.1/24
+ListenPort = 51820
+
+# a
+[Peer]
+PublicKey = key_a
+AllowedIPs = 10.0.0.2/32
+AllowedIPs = fd00::2/128
+
+# b
+[Peer]
+PublicKey = key_b
+AllowedIPs = 10.0.0.3/32
+"""
+
+NEW = b"""[Interface]
+PrivateKey = new_private
+Address = 10.0.0.1/24
+ListenPort = 51821
+
+# a
+[Peer]
+PublicKey = key_a
+AllowedIPs = 10.0.0.2/32
+
+[Peer]
+PublicKey = key_c
+AllowedIPs = 10.0.0.4/32
+"""
+
+
+class TestDiff(unittest.TestCase):
+  def test_split_config(self):
+    interface, peers = split_config(OLD)
+    self.assertTrue(interface.startswith("[Interface]"))
+    self.assertNotIn("# a", interface)
+    self.assertEqual(["a", "b"], list(peers))
+    self.assertTrue(peers["b"].endswith("AllowedIPs = 10.0.0.3/32"))
+
+  def test_diff_config(self):
+    d = diff_config("hub", OLD, NEW)
+    self.assertEqual(CONFIG_DIFF_STATUS.CHANGED, d.status)
+    self.assertEqual(
+      {
+        "PrivateKey": ("(hidden)", "(hidden)"),
+        "ListenPort": ("51820", "51821")
+      }, d.interface)
+    self.assertEqual(["key_c"], d.added_peers)
+    self.assertEqual(["b"], d.removed_peers)
+    self.assertEqual(
+      {"a": {
+        "AllowedIPs": ("10.0.0.2/32, fd00::2/128", "10.0.0.2/32")
+      }}, d.changed_peers)
+
+  def test_diff_configs(self):
+    diffs = diff_configs({"a": OLD, "b": OLD, "c": OLD}, {"b": OLD, "c": NEW, "d": NEW})
+    self.assertEqual(["c", "d", "a"], list(diffs))
+    self.assertEqual(CONFIG_DIFF_STATUS.ADDED, diffs["d"].status)
+    self.assertEqual(["a", "key_c"], diffs["d"].added_peers)
+    self.assertEqual(CONFIG_DIFF_STATUS.REMOVED, diffs["a"].status)
+    self.assertEqual(["a", "b"], diffs["a"].removed_peers)
+
+
+if __name__ == "__main__":
+  unittest.main()
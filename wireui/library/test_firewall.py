@@ -0,0 +1,35 @@
+import unittest
+
+from .firewall import get_nftables_post_down
+from .firewall import get_nftables_ruleset
+from .firewall import get_table_name
+from .firewall import FirewallNetworks
+
+
+class TestFirewall(unittest.TestCase):
+  def test_ruleset(self):
+    ruleset = get_nftables_ruleset(
+      "wg_hub",
+      FirewallNetworks(
+        peers=["10.0.0.2/32", "10.0.0.3/32", "192.168.2.0/24", "invalid"],
+        local=["10.0.0.1/32"],
+        gateway=[]))
+    self.assertTrue(
+      ruleset.startswith("# wg_hub\ntable inet wireui_wg_hub\n"
+                         "delete table inet wireui_wg_hub\n"))
+    self.assertIn("elements = { 10.0.0.2/31, 192.168.2.0/24 }\n", ruleset)
+    self.assertNotIn("invalid", ruleset)
+    # Empty sets have no elements
+    self.assertIn("set gateway_ipv4 {\n    type ipv4_addr\n    flags interval\n  }",
+                  ruleset)
+    self.assertIn('iifname "wg_hub" ip saddr @peers_ipv4 accept\n', ruleset)
+    self.assertEqual(2, ruleset.count('iifname "wg_hub" drop\n'))
+
+  def test_table_name(self):
+    self.assertEqual("wireui_wg_a_b", get_table_name("wg_a-b"))
+    self.assertEqual("nft delete table inet wireui_wg_a_b;",
+                     get_nftables_post_down("wg_a-b"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from .index import KEY_INDEX_MESSAGE_TYPE
+from .index import KeyIndex
+from .keys import create_keys
+
+
+class TestKeyIndex(unittest.TestCase):
+  def test_find_pubkey(self):
+    index = KeyIndex()
+    keys = create_keys()
+    self.assertTrue(index.add_peer("Site", "Alpha", keys).get_success())
+    self.assertEqual(("Site", "Alpha"), index.find_pubkey(keys["pubkey"]))
+    self.assertIsNone(index.find_pubkey(keys["privkey"]))
+
+    index.remove_peer("Site", "Alpha", keys)
+    self.assertIsNone(index.find_pubkey(keys["pubkey"]))
+    self.assertEqual(0, len(index))
+
+  def test_duplicate(self):
+    index = KeyIndex()
+    keys = create_keys()
+    index.add_peer("Site", "Alpha", keys)
+    r = index.add_peer("Other", "Beta", {"pubkey": keys["pubkey"]})
+    self.assertFalse(r.get_success())
+    self.assertEqual(KEY_INDEX_MESSAGE_TYPE.KEY_DUPLICATE,
+                     r[0].get_message().message_type)
+    self.assertEqual(("Site", "Alpha"),
+                     (r[0].get_message().site, r[0].get_message().peer))
+    self.assertEqual([keys["pubkey"]], list(index.get_duplicates()))
+
+    index.remove_peer("Other", "Beta", {"pubkey": keys["pubkey"]})
+    self.assertEqual({}, index.get_duplicates())
+
+  def test_malformed(self):
+    index = KeyIndex()
+    r = index.add_peer("Site", "Alpha", {"pubkey": "abc", "psk": "a" * 44})
+    self.assertEqual(2, len(r))
+    for m in r:
+      self.assertEqual(KEY_INDEX_MESSAGE_TYPE.KEY_MALFORMED,
+                       m.get_message().message_type)
+
+
+if __name__ == "__main__":
+  unittest.main()
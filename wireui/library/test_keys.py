@@ -0,0 +1,287 @@
+import asyncio
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from .curve25519 import x25519
+from .curve25519 import x25519_base
+from .keys import check_wireguard
+from .keys import create_keys
+from .keys import create_keys_batch
+from .keys import create_keys_parallel
+from .keys import derive_psk
+from .keys import get_keys
+from .keys import get_keys_async
+from .keys import get_pubkey
+from .keys import set_async_concurrency
+from .keys import set_key_backend
+from .keys import set_wg_exec
+from .keys import set_wg_probe_cache_path
+from .keys import KeyPool
+from .keys import LinkPsks
+from .keys import WgSession
+from .typedefs import WireguardNotFoundError
+
+
+class TestCurve25519(unittest.TestCase):
+  def test_rfc7748_vector(self):
+    scalar = bytes.fromhex(
+      "a546e36bf0527c9d3b16154b82465edd62144c0ac1fc5a18506a2244ba449ac4")
+    u = bytes.fromhex(
+      "e6db6867583030db3594c1a424b15f7c726624ec26b3353b10a903a6d0ab1c4c")
+    self.assertEqual(
+      "c3da55379de9c6908e94ea4df28d084f32eccf03491c71f754b4075577a28552",
+      x25519(scalar, u).hex())
+
+  def test_rfc7748_diffie_hellman(self):
+    alice = bytes.fromhex(
+      "77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a")
+    bob = bytes.fromhex(
+      "5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb")
+    self.assertEqual(
+      "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a",
+      x25519_base(alice).hex())
+    self.assertEqual(
+      "4a5d9d5ba4ce2de1728e3bf480350f25e07e21c947d19e3376f09b3c1e161742",
+      x25519(alice, x25519_base(bob)).hex())
+
+
+class TestKeys(unittest.TestCase):
+  def test_python_backend(self):
+    set_key_backend("python")
+    keys = get_keys()
+    for k in ["privkey", "pubkey", "psk"]:
+      self.assertEqual(44, len(keys[k]))
+      self.assertEqual(32, len(base64.b64decode(keys[k])))
+    self.assertEqual(keys["pubkey"], get_pubkey(keys["privkey"]))
+
+    privkey = base64.b64decode(keys["privkey"])
+    self.assertEqual(0, privkey[0] & 7)
+    self.assertEqual(64, privkey[31] & 192)
+
+  def test_create_keys_parallel(self):
+    set_key_backend("python")
+    keys = create_keys_parallel(5, 2)
+    self.assertEqual(5, len(keys))
+    self.assertEqual(5, len(set(k["privkey"] for k in keys)))
+    for k in keys:
+      self.assertEqual(k["pubkey"], get_pubkey(k["privkey"]))
+    self.assertEqual([], create_keys_parallel(0, 2))
+
+  def test_link_psks(self):
+    secret = base64.b64encode(bytes(range(32))).decode("ascii")
+    peers = {
+      p: {
+        "keys": {
+          "psk": base64.b64encode(bytes([i] * 32)).decode("ascii")
+        }
+      }
+      for i, p in enumerate(["Alpha", "Beta", "Gamma"])
+    }
+    psks = LinkPsks(secret, peers)
+    self.assertEqual(psks.get_psk("Alpha", "Beta"), psks.get_psk("Beta", "Alpha"))
+    self.assertNotEqual(psks.get_psk("Alpha", "Beta"),
+                        psks.get_psk("Alpha", "Gamma"))
+    self.assertEqual(
+      derive_psk(bytes(range(32)), ("Beta", peers["Beta"]["keys"]["psk"]),
+                 ("Alpha", peers["Alpha"]["keys"]["psk"])),
+      psks.get_psk("Alpha", "Beta"))
+    self.assertEqual(2, len(psks))
+
+    # A new psk of one peer changes the psks of its links
+    old_psk = psks.get_psk("Alpha", "Beta")
+    peers["Beta"]["keys"]["psk"] = peers["Gamma"]["keys"]["psk"]
+    self.assertNotEqual(old_psk, LinkPsks(secret, peers).get_psk("Alpha", "Beta"))
+
+  def test_error(self):
+    self.assertRaises(ValueError, set_key_backend, "openssl")
+
+
+class TestKeyPool(unittest.TestCase):
+  def test_hits(self):
+    pool = KeyPool(low_watermark=0, high_watermark=4, create_keys=create_keys)
+    try:
+      deadline = time.monotonic() + 5
+      while pool.stats.size < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+      self.assertEqual(4, pool.stats.size)
+
+      keys = [pool.get() for _ in range(4)]
+      self.assertEqual(4, pool.stats.hits)
+      self.assertEqual(0, pool.stats.misses)
+      self.assertEqual(4, len(set(k["privkey"] for k in keys)))
+    finally:
+      pool.close()
+
+  def test_misses(self):
+    release = threading.Event()
+
+    def create():
+      # Keep the background thread from filling the pool
+      if threading.current_thread().name == "wireui-key-pool":
+        release.wait(5)
+      return create_keys()
+
+    pool = KeyPool(low_watermark=0, high_watermark=4, create_keys=create)
+    try:
+      self.assertEqual(44, len(pool.get()["privkey"]))
+      self.assertEqual(0, pool.stats.hits)
+      self.assertEqual(1, pool.stats.misses)
+    finally:
+      pool.close()
+      release.set()
+
+  def test_retry(self):
+    failures = [RuntimeError("first"), RuntimeError("second")]
+
+    def create():
+      if failures:
+        raise failures.pop(0)
+      return create_keys()
+
+    pool = KeyPool(low_watermark=0, high_watermark=4, create_keys=create)
+    try:
+      deadline = time.monotonic() + 5
+      while pool.stats.size < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+      self.assertEqual(4, pool.stats.size)
+      self.assertEqual(2, pool.stats.errors)
+      self.assertEqual("second", str(pool.stats.last_error))
+    finally:
+      pool.close()
+
+  def test_error(self):
+    self.assertRaises(ValueError, KeyPool, 4, 4, create_keys)
+    self.assertRaises(ValueError, KeyPool, -1, 4, create_keys)
+
+
+# Stub for the wg executable: every call is logged and genkey counts its calls
+WG_STUB = """#!/bin/sh
+echo "$1" >> "$0.log"
+case "$1" in
+  genkey)
+    n=$(cat "$0.count" 2>/dev/null || echo 0)
+    n=$((n + 1))
+    echo "$n" > "$0.count"
+    echo "priv$n";;
+  pubkey)
+    read -r k
+    echo "pub-$k";;
+  genpsk)
+    echo "cHNrcHNrcHNrcHNrcHNrcHNrcHNrcHNrcHNrcHNrcHM=";;
+esac
+"""
+
+
+@unittest.skipUnless(os.name == "posix" and shutil.which("sh"), "requires sh")
+class TestWgSession(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.wg_exec = os.path.join(self.directory, "wg")
+    with open(self.wg_exec, "w") as f:
+      f.write(WG_STUB)
+    os.chmod(self.wg_exec, 0o755)
+
+  def tearDown(self):
+    set_key_backend("python")
+    set_wg_exec("")
+    set_wg_probe_cache_path("")
+    shutil.rmtree(self.directory)
+
+  def get_calls(self) -> list:
+    with open(self.wg_exec + ".log") as f:
+      return f.read().split()
+
+  def test_create_keys(self):
+    session = WgSession(self.wg_exec)
+    try:
+      keys = session.create_keys(3) + session.create_keys(2)
+    finally:
+      session.close()
+
+    self.assertEqual(5, len(keys))
+    for i, k in enumerate(keys, 1):
+      self.assertEqual(f"priv{i}", k["privkey"])
+      self.assertEqual(f"pub-priv{i}", k["pubkey"])
+      self.assertEqual("cHNrcHNrcHNrcHNrcHNrcHNrcHNrcHNrcHNrcHNrcHM=",
+                       k["psk"])
+
+  def test_create_keys_batch(self):
+    set_key_backend("wg_batch")
+    set_wg_exec(self.wg_exec)
+    keys = create_keys_batch(4)
+    self.assertEqual(["priv1", "priv2", "priv3", "priv4"],
+                     [k["privkey"] for k in keys])
+    self.assertEqual("priv5", create_keys()["privkey"])
+
+  def test_get_keys_async(self):
+    set_key_backend("wg")
+    set_wg_exec(self.wg_exec)
+    set_async_concurrency(4)
+
+    async def create():
+      return await asyncio.gather(*[get_keys_async(timeout=10) for _ in range(8)])
+
+    keys = asyncio.run(create())
+    self.assertEqual(8, len(keys))
+    self.assertEqual(8, self.get_calls().count("genkey"))
+    for k in keys:
+      self.assertEqual("pub-" + k["privkey"], k["pubkey"])
+    self.assertEqual(9, self.get_calls().count("genpsk"))
+
+  def test_get_keys_async_cancel(self):
+    # genkey never returns and leaves its pid
+    with open(self.wg_exec, "w") as f:
+      f.write(WG_STUB.replace('    echo "priv$n";;',
+                              '    echo $$ > "$0.pid"; exec sleep 60;;'))
+    set_key_backend("wg")
+    set_wg_exec(self.wg_exec)
+
+    async def cancel():
+      task = asyncio.ensure_future(get_keys_async())
+      for _ in range(500):
+        if os.path.exists(self.wg_exec + ".pid"):
+          break
+        await asyncio.sleep(0.01)
+      task.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await task
+
+    asyncio.run(cancel())
+    with open(self.wg_exec + ".pid") as f:
+      pid = int(f.read())
+    self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+
+  def test_check_wireguard_cache(self):
+    set_wg_probe_cache_path(os.path.join(self.directory, "wg_probe.json"))
+    set_wg_exec(self.wg_exec)
+    check_wireguard()
+    check_wireguard()
+    self.assertEqual(["genpsk"], self.get_calls())
+
+    # A new process is simulated by resetting the wg executable
+    set_wg_exec(self.wg_exec)
+    check_wireguard()
+    self.assertEqual(["genpsk"], self.get_calls())
+
+    # A changed executable is checked again
+    with open(self.wg_exec, "a") as f:
+      f.write("\n")
+    set_wg_exec(self.wg_exec)
+    check_wireguard()
+    self.assertEqual(["genpsk", "genpsk"], self.get_calls())
+
+  def test_error(self):
+    set_wg_exec(os.path.join(self.directory, "missing"))
+    self.assertRaises(WireguardNotFoundError, check_wireguard)
+
+    session = WgSession(os.path.join(self.directory, "missing"))
+    self.assertRaises(WireguardNotFoundError, session.create_keys, 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,336 @@
+import asyncio
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from . import wireui
+from .integrity import check_imported_sites
+from .integrity import IP_NETWORK_MESSAGE_TYPE
+from .integrity import PSK_MESSAGE_TYPE
+from .keys import get_keys
+from .typedefs import KeyIndexError
+from .typedefs import PeerDoesExistError
+from .typedefs import PeerDoesNotExistError
+from .wireui import Peer
+from .wireui import RedirectAllTraffic
+from .wireui import Site
+from .wireui import WireUI
+
+
+def get_peer(name: str, **kwargs) -> Peer:
+  properties = {
+    "name": name,
+    "additional_allowed_ips": [],
+    "outgoing_connected_peers": [],
+    "main_peer": "None",
+    "ingoing_connected_peers": [],
+    "endpoint": "",
+    "port": 0,
+    "dns": [],
+    "persistent_keep_alive": 25,
+    "redirect_all_traffic": RedirectAllTraffic(False, False),
+    "post_up": "",
+    "post_down": "",
+    "ipv6_routing_fix": False,
+  }
+  properties.update(kwargs)
+  return Peer(**properties)
+
+
+def get_site(name: str, psk_mode: str = "peer") -> Site:
+  """ Get a site with the hub "hub", the roadwarrior "a" and the peer "zz"
+  with its own key, which is connected in both directions to the hub """
+
+  own_keys = get_keys()
+  return Site(
+    name=name,
+    ip_networks=["10.0.0.0/24"],
+    dns=["1.1.1.1"],
+    psk_mode=psk_mode,
+    peers=[
+      get_peer("hub",
+               outgoing_connected_peers=["zz"],
+               main_peer="zz",
+               ingoing_connected_peers=["a", "zz"],
+               endpoint="hub.example.com",
+               port=51820),
+      get_peer("a", outgoing_connected_peers=["hub"], main_peer="hub"),
+      get_peer("zz",
+               outgoing_connected_peers=["hub"],
+               main_peer="hub",
+               ingoing_connected_peers=["hub"],
+               endpoint="zz.example.com",
+               port=51820,
+               pubkey=own_keys["pubkey"],
+               psk=own_keys["psk"]),
+    ])
+
+
+class TestWireUI(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    settings_path = os.path.join(self.directory, "settings.json")
+    with open(settings_path, "w") as f:
+      json.dump(
+        {
+          "sites_file_path": os.path.join(self.directory, "sites.json"),
+          "wg_config_path": os.path.join(self.directory, "wg"),
+          "wg_probe_cache_path": os.path.join(self.directory, "wg_probe.json"),
+        }, f)
+    WireUI._WireUI__instance = None
+    self.w = WireUI.get_instance(settings_path)
+
+  def tearDown(self):
+    WireUI._WireUI__instance = None
+    shutil.rmtree(self.directory)
+
+  def get_keys(self, site_name: str, peer_name: str) -> dict:
+    return dict(self.w._sites[site_name]["peers"][peer_name]["keys"])
+
+
+class TestOwnKeys(TestWireUI):
+  def test_config_files(self):
+    site = get_site("s")
+    self.w.add_site(site)
+    result = self.w.create_wireguard_config("s")
+    self.assertEqual(
+      [os.path.join(self.directory, "wg", "s", f"wg_{p}.conf") for p in ["hub", "a"]],
+      result.written)
+    self.assertRaises(ValueError, self.w.render_peer, "s", "zz")
+
+  def test_psk(self):
+    site = get_site("s")
+    self.w.add_site(site)
+    psk = site.peers[2].psk
+    # zz is outgoing and ingoing and "hub" sorts first
+    self.assertIn(f"PresharedKey = {psk}\n".encode("utf-8"),
+                  self.w.render_peer("s", "hub"))
+
+    # zz only outgoing
+    hub = self.w.get_peer("s", "hub")
+    self.w.set_peer("s", hub._replace(ingoing_connected_peers=["a"]))
+    self.assertIn(f"PresharedKey = {psk}\n".encode("utf-8"),
+                  self.w.render_peer("s", "hub"))
+
+  def test_link_psk(self):
+    site = get_site("s", psk_mode="link")
+    self.w.add_site(site)
+    config = self.w.render_peer("s", "hub")
+    # The link to zz uses the psk zz brings, the other links derived ones
+    self.assertIn(f"PresharedKey = {site.peers[2].psk}\n".encode("utf-8"),
+                  config)
+    self.assertEqual(
+      self.w.render_peer("s", "a").split(b"PresharedKey = ")[1][:44],
+      config.split(b"PresharedKey = ")[1][:44])
+
+  def test_rekey(self):
+    self.w.add_site(get_site("s"))
+    keys = self.get_keys("s", "zz")
+    self.w.rekey_peer("s", "zz")
+    new_keys = self.get_keys("s", "zz")
+    self.assertEqual(keys["pubkey"], new_keys["pubkey"])
+    self.assertNotEqual(keys["psk"], new_keys["psk"])
+    self.assertNotIn("privkey", new_keys)
+
+  def test_set_peer(self):
+    self.w.add_site(get_site("s"))
+    keys = self.get_keys("s", "zz")
+    zz = self.w.get_peer("s", "zz")
+    self.assertEqual((keys["pubkey"], keys["psk"]), (zz.pubkey, zz.psk))
+    self.w.set_peer("s", zz._replace(port=1234))
+    self.assertEqual(keys, self.get_keys("s", "zz"))
+
+    # Without a new psk the stored psk is kept
+    self.w.set_peer("s", zz._replace(psk=None))
+    self.assertEqual(keys, self.get_keys("s", "zz"))
+
+
+class TestRekeySite(TestWireUI):
+  def test_rekey_site(self):
+    self.w.add_site(get_site("s"))
+    self.w.create_wireguard_config("s")
+    old_keys = {p: self.get_keys("s", p) for p in ["hub", "a", "zz"]}
+    with mock.patch.object(wireui, "write_config",
+                           wraps=wireui.write_config) as write_config:
+      result = self.w.rekey_site("s", workers=2)
+    self.assertEqual(1, write_config.call_count)
+    self.assertEqual(
+      [os.path.join(self.directory, "wg", "s", f"wg_{p}.conf") for p in ["hub", "a"]],
+      result.written)
+
+    # All keys are replaced
+    for p in ["hub", "a"]:
+      keys = self.get_keys("s", p)
+      for k in ["privkey", "pubkey", "psk"]:
+        self.assertNotEqual(old_keys[p][k], keys[k])
+      self.assertEqual(("s", p), self.w.find_peer_by_pubkey(keys["pubkey"]))
+      self.assertIsNone(self.w.find_peer_by_pubkey(old_keys[p]["pubkey"]))
+
+    # A peer with its own key is left out by default
+    self.assertEqual(old_keys["zz"], self.get_keys("s", "zz"))
+
+    # and only gets a new psk if it is given
+    self.w.rekey_site("s", ["a", "zz"], workers=1)
+    keys = self.get_keys("s", "zz")
+    self.assertEqual(old_keys["zz"]["pubkey"], keys["pubkey"])
+    self.assertNotEqual(old_keys["zz"]["psk"], keys["psk"])
+
+  def test_link_psk(self):
+    self.w.add_site(get_site("s", psk_mode="link"))
+
+    def get_psk() -> bytes:
+      return self.w.render_site("s")["a"].split(b"PresharedKey = ")[1][:44]
+
+    # Rekeying one end of a link changes the psk of the link
+    psk = get_psk()
+    self.w.rekey_site("s")
+    self.assertNotEqual(psk, get_psk())
+    psk = get_psk()
+    self.w.rekey_peer("s", "a")
+    self.assertNotEqual(psk, get_psk())
+    psk = get_psk()
+    self.w.rekey_peer("s", "hub")
+    self.assertNotEqual(psk, get_psk())
+
+  def test_unknown_peer(self):
+    self.w.add_site(get_site("s"))
+    old_keys = {p: self.get_keys("s", p) for p in ["hub", "a", "zz"]}
+    with mock.patch.object(wireui, "write_config",
+                           wraps=wireui.write_config) as write_config:
+      self.assertRaises(PeerDoesNotExistError, self.w.rekey_site, "s",
+                        ["a", "b"])
+    self.assertEqual(0, write_config.call_count)
+    self.assertEqual(old_keys,
+                     {p: self.get_keys("s", p) for p in ["hub", "a", "zz"]})
+
+
+class TestAsync(TestWireUI):
+  def test_add_peer_async(self):
+    self.w.add_site(get_site("s"))
+    asyncio.run(self.w.add_peer_async("s", get_peer("b")))
+    keys = self.get_keys("s", "b")
+    self.assertIn("privkey", keys)
+    self.assertEqual(("s", "b"), self.w.find_peer_by_pubkey(keys["pubkey"]))
+
+    own_keys = get_keys()
+    asyncio.run(
+      self.w.add_peer_async(
+        "s", get_peer("c", pubkey=own_keys["pubkey"], psk=own_keys["psk"])))
+    self.assertEqual({
+      "pubkey": own_keys["pubkey"],
+      "psk": own_keys["psk"]
+    }, self.get_keys("s", "c"))
+
+  def test_rekey_peer_async(self):
+    self.w.add_site(get_site("s"))
+    old_keys = {p: self.get_keys("s", p) for p in ["a", "zz"]}
+    asyncio.run(self.w.rekey_peer_async("s", "a"))
+    keys = self.get_keys("s", "a")
+    for k in ["privkey", "pubkey", "psk"]:
+      self.assertNotEqual(old_keys["a"][k], keys[k])
+    self.assertEqual(("s", "a"), self.w.find_peer_by_pubkey(keys["pubkey"]))
+    self.assertIsNone(self.w.find_peer_by_pubkey(old_keys["a"]["pubkey"]))
+
+    # A peer with its own key only gets a new psk
+    asyncio.run(self.w.rekey_peer_async("s", "zz"))
+    keys = self.get_keys("s", "zz")
+    self.assertEqual(old_keys["zz"]["pubkey"], keys["pubkey"])
+    self.assertNotEqual(old_keys["zz"]["psk"], keys["psk"])
+
+  def test_changed_while_awaiting(self):
+    self.w.add_site(get_site("s"))
+    created = []
+
+    def get_keys_async(change):
+      async def f(timeout=None):
+        # The site is changed before the keys are returned
+        change()
+        created.append(get_keys())
+        return created[-1]
+
+      return f
+
+    # The peer is deleted
+    with mock.patch.object(wireui, "get_keys_async",
+                           get_keys_async(lambda: self.w.delete_peer("s", "a"))):
+      self.assertRaises(PeerDoesNotExistError, asyncio.run,
+                        self.w.rekey_peer_async("s", "a"))
+    self.assertIsNone(self.w.find_peer_by_pubkey(created[-1]["pubkey"]))
+
+    # A peer with the same name is added
+    b = get_peer("b")
+    with mock.patch.object(wireui, "get_keys_async",
+                           get_keys_async(lambda: self.w.add_peer("s", b))):
+      self.assertRaises(PeerDoesExistError, asyncio.run,
+                        self.w.add_peer_async("s", b))
+    self.assertIsNone(self.w.find_peer_by_pubkey(created[-1]["pubkey"]))
+    self.assertEqual(("s", "b"),
+                     self.w.find_peer_by_pubkey(self.get_keys("s", "b")["pubkey"]))
+    self.assertEqual({}, self.w.get_key_duplicates())
+
+
+class TestKeyIndex(TestWireUI):
+  def test_duplicate_pubkey(self):
+    site = get_site("s")
+    self.w.add_site(site)
+    zz = site.peers[2]
+    self.assertRaises(KeyIndexError, self.w.add_peer, "s",
+                      zz._replace(name="yy", psk=None))
+    self.assertEqual(["hub", "a", "zz"], self.w.get_peer_names("s"))
+    self.assertEqual(("s", "zz"), self.w.find_peer_by_pubkey(zz.pubkey))
+
+    # The same key in another site
+    self.assertRaises(KeyIndexError, self.w.add_site, site._replace(name="t"))
+    self.assertFalse(self.w.site_exists("t"))
+
+    # set_peer keeps the old keys
+    yy = get_peer("yy", pubkey=get_keys()["pubkey"], psk=get_keys()["psk"])
+    self.w.add_peer("s", yy)
+    keys = self.get_keys("s", "yy")
+    self.assertRaises(KeyIndexError, self.w.set_peer, "s",
+                      yy._replace(pubkey=zz.pubkey))
+    self.assertEqual(keys, self.get_keys("s", "yy"))
+    self.assertEqual({}, self.w.get_key_duplicates())
+
+    # Everything that was accepted passes the startup check
+    self.assertTrue(check_imported_sites(self.w._sites).get_success())
+
+
+class TestIntegrity(TestWireUI):
+  def test_network_exhausted(self):
+    self.w.add_site(get_site("s"))
+    sites = copy.deepcopy(self.w._sites)
+    # Two addresses for three peers
+    sites["s"]["ip_networks"] = ["10.0.0.0/30"]
+    result = check_imported_sites(sites)
+    self.assertFalse(result.get_success())
+    messages = [m.content for r in result["s"].site_result for m in r]
+    self.assertIn(("10.0.0.0/30", 30),
+                  [(m.ip_network, m.prefix) for m in messages
+                   if m.message_type == IP_NETWORK_MESSAGE_TYPE.NETWORK_EXHAUSTED])
+
+  def test_psk(self):
+    self.w.add_site(get_site("s", psk_mode="link"))
+    sites = copy.deepcopy(self.w._sites)
+    self.assertTrue(check_imported_sites(copy.deepcopy(sites)).get_success())
+    sites["s"]["psk_mode"] = "site"
+    sites["s"]["psk_secret"] = "secret"
+    result = check_imported_sites(sites)
+    self.assertFalse(result.get_success())
+    self.assertEqual(
+      [PSK_MESSAGE_TYPE.PSK_MODE_INVALID, PSK_MESSAGE_TYPE.PSK_SECRET_INVALID],
+      [
+        m.content.message_type for r in result["s"].site_result for m in r
+        if m.content.message_type in [
+          PSK_MESSAGE_TYPE.PSK_MODE_INVALID,
+          PSK_MESSAGE_TYPE.PSK_SECRET_INVALID
+        ]
+      ])
+
+
+if __name__ == "__main__":
+  unittest.main()
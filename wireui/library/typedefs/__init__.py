@@ -2,9 +2,11 @@ from .dicts import JSONDecodeError
 from .dicts import JsonDict
 from .dicts import ReadOnlyJsonDict
 
+from .exceptions import AddressPoolExhaustedError
 from .exceptions import DataIntegrityError
 from .exceptions import KeyDoesExistError
 from .exceptions import KeyDoesNotExistError
+from .exceptions import KeyIndexError
 from .exceptions import PeerDoesExistError
 from .exceptions import PeerDoesNotExistError
 from .exceptions import SettingDoesExistError
@@ -40,6 +42,7 @@ from .tables import ConnectionTableMessageContent
 
 __all__ = [
   "MESSAGE_LEVEL",
+  "AddressPoolExhaustedError",
   "BasicList",
   "CONNECTION_TABLE_MESSAGE_TYPE",
   "ConnectionTable",
@@ -53,6 +56,7 @@ __all__ = [
   "Keys",
   "KeyDoesExistError",
   "KeyDoesNotExistError",
+  "KeyIndexError",
   "Message",
   "MessageContent",
   "PeerItems",
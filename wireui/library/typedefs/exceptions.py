@@ -48,3 +48,13 @@ class WireguardNotFoundError(Error):
 
 class DataIntegrityError(Error):
   pass
+
+
+class KeyIndexError(Error):
+  pass
+
+
+class AddressPoolExhaustedError(Error):
+  def __init__(self, network):
+    self.network = network
+    super().__init__(f"There is no free address left in {network}")
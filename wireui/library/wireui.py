@@ -2,16 +2,32 @@
 # Get keys from wg Write wireguard config files
 # Author: Tim Schlottmann
 
+import copy
 import ipaddress
 
 from os import path
 import os
+from typing import Dict
 from typing import List
 from typing import NamedTuple
 from typing import Optional
+from typing import Tuple
+
+from .addresses import AddressAllocator
 
 from .config import delete_config
+from .config import get_adjacency
+from .config import get_section_cache_stats
+from .config import read_configs
+from .config import render_nftables_ruleset
+from .config import render_peer
+from .config import render_site
 from .config import write_config
+from .config import write_configs
+from .config import Adjacency
+from .config import ConfigWriteResult
+from .config import SectionCacheStats
+from .config import SiteWriteResult
 
 from .integrity import check_additional_allowed_ips
 from .integrity import check_dns
@@ -20,18 +36,39 @@ from .integrity import check_imported_settings
 from .integrity import check_imported_sites
 from .integrity import check_ip_networks
 from .integrity import check_port
-from .integrity import check_wireguard
 from .integrity import settings_latest_version
 from .integrity import site_latest_version
 from .integrity import DataIntegrityResult
 
+from .diff import diff_configs
+from .diff import ConfigDiff
+
+from .index import KeyIndex
+from .index import KeyOwner
+from .index import KEY_INDEX_MESSAGE_TYPE
+
 from .io_ import read_file
 from .io_ import write_file
 
+from .keys import create_keys_parallel
+from .keys import get_key_pool_stats
 from .keys import get_keys
+from .keys import get_keys_async
+from .keys import get_psk
+from .keys import is_own_key_peer
+from .keys import is_valid_key
+from .keys import PSK_MODES
+from .keys import set_async_concurrency
+from .keys import set_key_backend
+from .keys import set_key_pool
+from .keys import set_wg_probe_cache_path
 from .keys import set_wg_exec
+from .keys import KeyPoolStats
 
+from .typedefs import AddressPoolExhaustedError
 from .typedefs import JSONDecodeError
+from .typedefs import KeyIndexError
+from .typedefs import Keys
 from .typedefs import PeerItems
 from .typedefs import PeerDoesExistError
 from .typedefs import PeerDoesNotExistError
@@ -51,6 +88,7 @@ class Site(NamedTuple):
   ip_networks: list
   dns: list
   peers: list
+  psk_mode: str = "peer"
 
 
 class RedirectAllTraffic(NamedTuple):
@@ -72,6 +110,11 @@ class Peer(NamedTuple):
   post_up: str
   post_down: str
   ipv6_routing_fix: bool
+  # Peers that bring their own key only have a public key (and optionally a
+  # preshared key). No private key is created or stored and no config file
+  # is written for them.
+  pubkey: Optional[str] = None
+  psk: Optional[str] = None
 
 
 class WireUI():
@@ -100,6 +143,16 @@ class WireUI():
       "wg_config_path": "./wg",
       "editor": "editor",
       "wg_exec": "wg",
+      "key_backend": "python",
+      "key_pool_low_watermark": 0,
+      "key_pool_high_watermark": 0,
+      "wg_probe_cache_path": "./wg_probe.json",
+      "async_concurrency": 16,
+      "render_workers": 1,
+      "output_mode": "incremental",
+      "syncconf_files": False,
+      "aggregate_allowed_ips": False,
+      "nftables_path": "",
     }
     if os.name in ("dos", "nt"):
       default_settings["editor"] = "C:\\Windows\\System32\\notepad.exe"
@@ -117,8 +170,16 @@ class WireUI():
 
     check_imported_settings(self._settings)
     set_wg_exec(self.get_setting("wg_exec"))
-    check_wireguard()
-    self.__data_integrity_result = check_imported_sites(self._sites)
+    set_wg_probe_cache_path(self.get_setting("wg_probe_cache_path"))
+    set_key_backend(self.get_setting("key_backend"))
+    set_async_concurrency(self.get_setting("async_concurrency"))
+    set_key_pool(self.get_setting("key_pool_low_watermark"),
+                 self.get_setting("key_pool_high_watermark"))
+    self._key_index = KeyIndex()
+    # Connected peers of the sites, built on demand for rendering
+    self.__adjacency: Dict[str, Adjacency] = {}
+    self.__data_integrity_result = check_imported_sites(
+      self._sites, self._key_index)
 
   @property
   def startup_result(self) -> DataIntegrityResult:
@@ -140,7 +201,10 @@ class WireUI():
     #   for r in results:
     #     print(r)
     # else:
-    self._sites[site.name] = self.__get_site_items(site)
+    site_items = self.__get_site_items(site)
+    self.__update_index(site.name, {}, self.__get_site_keys(site_items))
+    self._sites[site.name] = site_items
+    self.__adjacency.pop(site.name, None)
 
   def get_site(self, site_name: str) -> Site:
     if site_name not in self._sites:
@@ -171,6 +235,7 @@ class WireUI():
           post_down=self._sites[site_name]["peers"][p]["post_down"],
           ipv6_routing_fix=self._sites[site_name]["peers"][p]
           ["ipv6_routing_fix"],
+          **self.__get_own_key_fields(self._sites[site_name]["peers"][p]),
         ))
 
     return Site(
@@ -178,6 +243,7 @@ class WireUI():
       ip_networks=self._sites[site_name]["ip_networks"],
       dns=self._sites[site_name]["dns"],
       peers=peers,
+      psk_mode=self._sites[site_name]["psk_mode"],
     )
 
   def set_site(self, site: Site):
@@ -192,7 +258,12 @@ class WireUI():
     #   if r:
     #     raise DataIntegrityError(str(r))
     # else:
-    self._sites[site.name] = self.__get_site_items(site)
+    site_items = self.__get_site_items(site)
+    self.__update_index(site.name,
+                        self.__get_site_keys(self._sites[site.name]),
+                        self.__get_site_keys(site_items))
+    self._sites[site.name] = site_items
+    self.__adjacency.pop(site.name, None)
 
   def delete_site(self, name: str):
     """ Delete a site """
@@ -200,7 +271,9 @@ class WireUI():
     if name not in self._sites:
       raise SiteDoesNotExistError(name)
 
+    self.__update_index(name, self.__get_site_keys(self._sites[name]), {})
     del self._sites[name]
+    self.__adjacency.pop(name, None)
 
   def site_exists(self, name: str) -> bool:
     """ Check if a site does exist """
@@ -233,11 +306,34 @@ class WireUI():
 
     # self.__check_peer(peer, allow_ipv4=allow_ipv4, allow_ipv6=allow_ipv6)
 
-    self._sites[site_name]["peers"][peer.name] = self.__get_peer_items(
-      site_name=site_name,
-      peer=peer,
-      create_new_keys=True,
-    )
+    keys = self.__get_new_keys(peer)
+    self.__add_peer(site_name, peer, keys)
+
+  async def add_peer_async(self,
+                           site_name: str,
+                           peer: Peer,
+                           timeout: Optional[float] = None):
+    """ Add a peer to a site without blocking the event loop """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer.name in self._sites[site_name]["peers"]:
+      raise PeerDoesExistError(peer.name)
+
+    if peer.pubkey:
+      keys = self.__get_own_keys(peer)
+    else:
+      keys = await get_keys_async(timeout=timeout)
+
+    # The site could have been changed while the keys were created
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer.name in self._sites[site_name]["peers"]:
+      raise PeerDoesExistError(peer.name)
+
+    self.__add_peer(site_name, peer, keys)
 
   def get_peer(self, site_name: str, peer_name: str) -> Peer:
     """ Get a peer from a site """
@@ -272,6 +368,7 @@ class WireUI():
       self._sites[site_name]["peers"][peer_name]["post_up"],
       self._sites[site_name]["peers"][peer_name]["post_down"],
       self._sites[site_name]["peers"][peer_name]["ipv6_routing_fix"],
+      **self.__get_own_key_fields(self._sites[site_name]["peers"][peer_name]),
     )
 
   def set_peer(self, site_name: str, peer: Peer):
@@ -287,11 +384,20 @@ class WireUI():
 
     # self.__check_peer(peer, allow_ipv4=allow_ipv4, allow_ipv6=allow_ipv6)
 
+    keys = self._sites[site_name]["peers"][peer.name]["keys"]
+    if peer.pubkey:
+      keys = self.__get_own_keys(peer, keys.get("psk"))
+
+    self.__update_index(
+      site_name,
+      {peer.name: self._sites[site_name]["peers"][peer.name]["keys"]},
+      {peer.name: keys})
     self._sites[site_name]["peers"][peer.name] = self.__get_peer_items(
       site_name=site_name,
       peer=peer,
-      create_new_keys=False,
+      keys=keys,
     )
+    self.__adjacency.pop(site_name, None)
 
   def delete_peer(self, site_name: str, peer_name: str):
     """ Delete a peer from a site """
@@ -302,7 +408,12 @@ class WireUI():
     if peer_name not in self._sites[site_name]["peers"]:
       raise PeerDoesNotExistError(peer_name)
 
+    self.__update_index(
+      site_name,
+      {peer_name: self._sites[site_name]["peers"][peer_name]["keys"]}, {})
     del self._sites[site_name]["peers"][peer_name]
+    self.__get_address_allocator(site_name).free(peer_name)
+    self.__adjacency.pop(site_name, None)
 
   def rekey_peer(self, site_name: str, peer_name: str):
     """ Create new keys for a peer from a site """
@@ -313,7 +424,114 @@ class WireUI():
     if peer_name not in self._sites[site_name]["peers"]:
       raise PeerDoesNotExistError(peer_name)
 
-    self._sites[site_name]["peers"][peer_name]["keys"] = get_keys()
+    keys = self._sites[site_name]["peers"][peer_name]["keys"]
+    if is_own_key_peer(self._sites[site_name]["peers"][peer_name]):
+      # Only the preshared key can be changed for peers with own keys
+      new_keys = Keys({**keys, "psk": get_psk()})
+    else:
+      new_keys = get_keys()
+    self.__update_index(site_name, {peer_name: keys}, {peer_name: new_keys})
+    self._sites[site_name]["peers"][peer_name]["keys"] = new_keys
+
+  async def rekey_peer_async(self,
+                             site_name: str,
+                             peer_name: str,
+                             timeout: Optional[float] = None):
+    """ Create new keys for a peer from a site without blocking the event loop """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer_name not in self._sites[site_name]["peers"]:
+      raise PeerDoesNotExistError(peer_name)
+
+    if is_own_key_peer(self._sites[site_name]["peers"][peer_name]):
+      self.rekey_peer(site_name, peer_name)
+      return
+
+    keys = await get_keys_async(timeout=timeout)
+
+    # The peer could have been deleted while the keys were created
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer_name not in self._sites[site_name]["peers"]:
+      raise PeerDoesNotExistError(peer_name)
+
+    self.__update_index(
+      site_name,
+      {peer_name: self._sites[site_name]["peers"][peer_name]["keys"]},
+      {peer_name: keys})
+    self._sites[site_name]["peers"][peer_name]["keys"] = keys
+
+  def rekey_site(self,
+                 site_name: str,
+                 peers: Optional[List[str]] = None,
+                 workers: Optional[int] = None) -> ConfigWriteResult:
+    """ Create new keys for all peers (or the given peers) of a site
+
+    The keys are created in parallel. Either all peers get new keys or none.
+    Afterwards the wireguard config files are written once.
+
+    Peers with own keys only get a new preshared key and only if they are
+    given in peers, because their devices are not configured by wireui. """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peers is None:
+      own_key_peers = []
+      peers = [
+        p for p in self._sites[site_name]["peers"]
+        if not is_own_key_peer(self._sites[site_name]["peers"][p])
+      ]
+    else:
+      for p in peers:
+        if p not in self._sites[site_name]["peers"]:
+          raise PeerDoesNotExistError(p)
+      own_key_peers = [
+        p for p in peers
+        if is_own_key_peer(self._sites[site_name]["peers"][p])
+      ]
+      peers = [p for p in peers if p not in own_key_peers]
+
+    if workers is None:
+      workers = os.cpu_count() or 1
+
+    new_keys = dict(zip(peers, create_keys_parallel(len(peers), workers)))
+    for p in own_key_peers:
+      new_keys[p] = Keys({
+        **self._sites[site_name]["peers"][p]["keys"], "psk": get_psk()
+      })
+    self.__update_index(
+      site_name,
+      {p: self._sites[site_name]["peers"][p]["keys"]
+       for p in new_keys}, new_keys)
+    for p in new_keys:
+      self._sites[site_name]["peers"][p]["keys"] = new_keys[p]
+
+    return self.create_wireguard_config(site_name)
+
+  def get_peer_addresses(self, site_name: str, peer_name: str) -> Dict[str, str]:
+    """ Get the ip address of a peer for every network of the site """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer_name not in self._sites[site_name]["peers"]:
+      raise PeerDoesNotExistError(peer_name)
+
+    return self.__get_address_allocator(site_name).get_addresses(peer_name)
+
+  def reserve_addresses(self, site_name: str, first: str, last: str):
+    """ Exclude the addresses from first to last from the allocation
+
+    The addresses must not be used by a peer. """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    self.__get_address_allocator(site_name).reserve(first, last)
 
   def peer_exists(self, site_name: str, peer_name: str) -> bool:
     """ Check if a peer exists in a site """
@@ -344,14 +562,111 @@ class WireUI():
   def get_dns(self, site_name: str) -> list:
     return self._sites[site_name]["dns"]
 
-  def create_wireguard_config(self, site_name: str) -> list:
-    """ Write the wireguard config files """
+  def create_wireguard_config(self, site_name: str) -> ConfigWriteResult:
+    """ Write the wireguard config files
+
+    Returns which files have been written, which were unchanged and which
+    have been removed. """
 
     if site_name not in self._sites:
       raise SiteDoesNotExistError(site_name)
 
     return write_config(self._sites[site_name],
-                        path.join(self._settings["wg_config_path"], site_name))
+                        path.join(self._settings["wg_config_path"], site_name),
+                        workers=self._settings["render_workers"],
+                        output_mode=self._settings["output_mode"],
+                        syncconf=self._settings["syncconf_files"],
+                        aggregate=self._settings["aggregate_allowed_ips"],
+                        nftables_path=self._settings["nftables_path"])
+
+  def create_all_wireguard_configs(
+      self,
+      workers: Optional[int] = None) -> Dict[str, SiteWriteResult]:
+    """ Write the wireguard config files of all sites
+
+    The sites are written in parallel. For every site the written, unchanged
+    and removed files, the duration and the error (if the site failed) are
+    returned. """
+
+    if workers is None:
+      workers = os.cpu_count() or 1
+
+    return write_configs(self._sites,
+                         self._settings["wg_config_path"],
+                         workers,
+                         output_mode=self._settings["output_mode"],
+                         syncconf=self._settings["syncconf_files"],
+                         aggregate=self._settings["aggregate_allowed_ips"],
+                         nftables_path=self._settings["nftables_path"])
+
+  def render_site(self,
+                  site_name: str,
+                  syncconf: bool = False) -> Dict[str, bytes]:
+    """ Get the wireguard config files of all peers without writing them
+
+    With syncconf the configs can be applied with wg syncconf. """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    return render_site(self._sites[site_name],
+                       adjacency=self.__get_adjacency(site_name),
+                       workers=self._settings["render_workers"],
+                       syncconf=syncconf,
+                       aggregate=self._settings["aggregate_allowed_ips"],
+                       nftables_path=self._settings["nftables_path"])
+
+  def render_peer(self,
+                  site_name: str,
+                  peer_name: str,
+                  syncconf: bool = False) -> bytes:
+    """ Get the wireguard config file of a peer without writing it
+
+    Only the peer and its connected peers are rendered. With syncconf the
+    config can be applied with wg syncconf. """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer_name not in self._sites[site_name]["peers"]:
+      raise PeerDoesNotExistError(peer_name)
+
+    return render_peer(self._sites[site_name],
+                       peer_name,
+                       adjacency=self.__get_adjacency(site_name),
+                       syncconf=syncconf,
+                       aggregate=self._settings["aggregate_allowed_ips"],
+                       nftables_path=self._settings["nftables_path"])
+
+  def render_nftables_ruleset(self, site_name: str, peer_name: str) -> bytes:
+    """ Get the nftables ruleset of a peer without writing it
+
+    The ruleset is compiled from the connections of the peer. """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    if peer_name not in self._sites[site_name]["peers"]:
+      raise PeerDoesNotExistError(peer_name)
+
+    return render_nftables_ruleset(self._sites[site_name],
+                                   peer_name,
+                                   adjacency=self.__get_adjacency(site_name))
+
+  def dry_run(self, site_name: str) -> Dict[str, ConfigDiff]:
+    """ Compare the written config files with the current state of a site
+
+    The config files are rendered in memory and compared section by section
+    with the written ones. Only config files that would change are returned.
+    Nothing is written. """
+
+    if site_name not in self._sites:
+      raise SiteDoesNotExistError(site_name)
+
+    return diff_configs(
+      read_configs(path.join(self._settings["wg_config_path"], site_name),
+                   self._settings["output_mode"]),
+      self.render_site(site_name))
 
   def delete_wireguard_config(self, site_name: str):
     """ Check if a peer exists in a site """
@@ -362,6 +677,26 @@ class WireUI():
     delete_config(site_name,
                   path.join(self._settings.get("wg_config_path"), site_name))
 
+  def find_peer_by_pubkey(self, pubkey: str) -> Optional[Tuple[str, str]]:
+    """ Get site name and peer name of the peer with the public key """
+
+    return self._key_index.find_pubkey(pubkey)
+
+  def get_key_duplicates(self) -> Dict[str, List[KeyOwner]]:
+    """ Get all keys that are used by more than one peer """
+
+    return self._key_index.get_duplicates()
+
+  def get_key_pool_stats(self) -> Optional[KeyPoolStats]:
+    """ Get hit and miss counters of the key pool (None if it is disabled) """
+
+    return get_key_pool_stats()
+
+  def get_section_cache_stats(self) -> SectionCacheStats:
+    """ Get hit and miss counters of the [Peer] section cache """
+
+    return get_section_cache_stats()
+
   def get_setting_names(self, setting: str) -> list:
     """ Get names of all existing settings """
 
@@ -387,7 +722,7 @@ class WireUI():
       try:
         peers[p.name] = PeerItems({
           "keys":
-          get_keys(),
+          self.__get_new_keys(p),
           "additional_allowed_ips":
           p.additional_allowed_ips,
           "outgoing_connected_peers":
@@ -419,15 +754,136 @@ class WireUI():
       except PeerDoesExistError as e:
         raise e
 
+    if site.psk_mode not in PSK_MODES:
+      raise ValueError(
+        f"Unknown psk mode {site.psk_mode}. Possible values are {PSK_MODES}")
+
+    # Keep the secret and the addresses of an existing site, so the link psks
+    # and the addresses of the remaining peers stay the same
+    if site.name in self._sites:
+      psk_secret = self._sites[site.name]["psk_secret"]
+      address_allocations = copy.deepcopy(
+        self._sites[site.name]["address_allocations"])
+    else:
+      psk_secret = get_psk()
+      address_allocations = {}
+    allocator = AddressAllocator(site.ip_networks, address_allocations)
+    allocator.free_unknown([p.name for p in site.peers])
+    for p in site.peers:
+      allocator.allocate(p.name)
+
     return SiteItems({
       "config_version": site_latest_version,
       "ip_networks": site.ip_networks,
       "dns": site.dns,
+      "psk_mode": site.psk_mode,
+      "psk_secret": psk_secret,
+      "address_allocations": address_allocations,
       "peers": peers
     })
 
+  def __get_adjacency(self, site_name: str) -> Adjacency:
+    if site_name not in self.__adjacency:
+      self.__adjacency[site_name] = get_adjacency(
+        self._sites[site_name]["peers"])
+    return self.__adjacency[site_name]
+
+  def __get_address_allocator(self, site_name: str) -> AddressAllocator:
+    return AddressAllocator(self._sites[site_name]["ip_networks"],
+                            self._sites[site_name]["address_allocations"])
+
+  def __allocate_addresses(self, site_name: str, peer_name: str):
+    """ Allocate the addresses of a new peer
+
+    If a network has no free address left, no address is allocated. """
+
+    allocator = self.__get_address_allocator(site_name)
+    try:
+      allocator.allocate(peer_name)
+    except AddressPoolExhaustedError:
+      allocator.free(peer_name)
+      raise
+
+  def __add_peer(self, site_name: str, peer: Peer, keys: Keys):
+    """ Add a peer with its keys and addresses to a site """
+
+    self.__update_index(site_name, {}, {peer.name: keys})
+    try:
+      self.__allocate_addresses(site_name, peer.name)
+    except AddressPoolExhaustedError:
+      self._key_index.remove_peer(site_name, peer.name, keys)
+      raise
+    self._sites[site_name]["peers"][peer.name] = self.__get_peer_items(
+      site_name=site_name,
+      peer=peer,
+      keys=keys,
+    )
+    self.__adjacency.pop(site_name, None)
+
+  @staticmethod
+  def __get_site_keys(site: SiteItems) -> Dict[str, Keys]:
+    return {p: site["peers"][p]["keys"] for p in site["peers"]}
+
+  def __update_index(self, site_name: str, old_keys: Dict[str, Keys],
+                     new_keys: Dict[str, Keys]):
+    """ Replace the keys of peers in the key index
+
+    The same checks as at startup are done: if a new key is malformed or
+    already used by another peer, the index is restored and a KeyIndexError
+    is raised. The caller has to change the site afterwards. """
+
+    for p in old_keys:
+      self._key_index.remove_peer(site_name, p, old_keys[p])
+
+    added = []
+    for p in new_keys:
+      r = self._key_index.add_peer(site_name, p, new_keys[p])
+      added.append(p)
+      if r.get_success():
+        continue
+
+      for a in added:
+        self._key_index.remove_peer(site_name, a, new_keys[a])
+      for o in old_keys:
+        self._key_index.add_peer(site_name, o, old_keys[o])
+      m = r[0].content
+      if m.message_type == KEY_INDEX_MESSAGE_TYPE.KEY_MALFORMED:
+        raise KeyIndexError(f"Key {m.key} of peer {p} is malformed")
+      raise KeyIndexError(
+        f"Key {m.key} of peer {p} is already used by peer {m.peer} in site {m.site}"
+      )
+
+  def __get_new_keys(self, peer: Peer) -> Keys:
+    """ Get the keys for a new peer """
+
+    if peer.pubkey:
+      return self.__get_own_keys(peer)
+    return get_keys()
+
+  def __get_own_keys(self, peer: Peer, psk: Optional[str] = None) -> Keys:
+    """ Get the keys for a peer that brings its own public key
+
+    If the peer has no preshared key, psk is used. If psk is not set either,
+    a new preshared key is created. """
+
+    for k in [peer.pubkey, peer.psk]:
+      if k is not None and not is_valid_key(k):
+        raise ValueError(f"{k} is not a valid wireguard key")
+
+    return Keys({
+      "pubkey": peer.pubkey,
+      "psk": peer.psk or psk or get_psk(),
+    })
+
+  def __get_own_key_fields(self, peer: PeerItems) -> dict:
+    """ Get pubkey and psk for Peer if the peer brings its own key """
+
+    if not is_own_key_peer(peer):
+      return {}
+    return {"pubkey": peer["keys"]["pubkey"], "psk": peer["keys"]["psk"]}
+
   def __get_peer_items(self, site_name: str, peer: Peer,
-                       create_new_keys: bool) -> PeerItems:
+                       keys: Keys) -> PeerItems:
 
     redirect_all_traffic = RedirectAllTraffic_({
       "ipv4":
@@ -436,11 +892,6 @@ class WireUI():
       peer.redirect_all_traffic.ipv6
     })
 
-    if create_new_keys:
-      keys = get_keys()
-    else:
-      keys = self._sites[site_name]["peers"][peer.name]["keys"]
-
     return PeerItems({
       "keys": keys,
       "additional_allowed_ips": peer.additional_allowed_ips,
@@ -9,6 +9,7 @@ from .peers import add_peer, edit_peer
 from .peers import delete_peer
 from .peers import rekey_peer
 
+from .shared import create_all_wireguard_configs
 from .shared import create_wireguard_config
 from .shared import edit_peer_connections
 
@@ -39,9 +40,10 @@ def entrypoint_menu(w: WireUI):
         "4": f"{strings['entrypoint_menu']['edit_connections']}",
         "5": f"{strings['entrypoint_menu']['site_menu']}",
         "6": f"{strings['entrypoint_menu']['config_files']}",
+        "7": f"{strings['entrypoint_menu']['config_files_all']}",
       })
       default = "6"
-      order = ["1", "2", "3", "4", "5", "6", "a", "q"]
+      order = ["1", "2", "3", "4", "5", "6", "7", "a", "q"]
 
     choice = options_menu(options=options, default=default, order=order)
 
@@ -62,6 +64,9 @@ def entrypoint_menu(w: WireUI):
     elif choice == "6":
       create_wireguard_config(w, get_site_name(w, should_exist=True))
       leave_menu()
+    elif choice == "7":
+      create_all_wireguard_configs(w)
+      leave_menu()
     elif choice == "a":
       leave_menu()
       __about()
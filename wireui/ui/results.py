@@ -6,9 +6,12 @@ from ..library import DNS_MESSAGE_TYPE
 from ..library import ENDPOINT_MESSAGE_TYPE
 from ..library import IP_NETWORK_MESSAGE_TYPE
 from ..library import KEY_DATATYPE_MESSAGE_TYPE
+from ..library import KEY_INDEX_MESSAGE_TYPE
 from ..library import KEY_PRESENCE_MESSAGE_TYPE
 from ..library import MESSAGE_LEVEL
 from ..library import PORT_MESSAGE_TYPE
+from ..library import PSK_MESSAGE_TYPE
+from ..library import PSK_MODES
 from ..library import AAIPsMessage
 from ..library import AAIPsMessageContent
 from ..library import ConnectionTableMessage
@@ -21,11 +24,15 @@ from ..library import IPNetworkMessage
 from ..library import IPNetworkMessageContent
 from ..library import KeyDatatypeMessage
 from ..library import KeyDatatypeMessageContent
+from ..library import KeyIndexMessage
+from ..library import KeyIndexMessageContent
 from ..library import KeyPresenceMessage
 from ..library import KeyPresenceMessageContent
 from ..library import Message
 from ..library import PortMessage
 from ..library import PortMessageContent
+from ..library import PskMessage
+from ..library import PskMessageContent
 from ..library import Result
 from ..library import ResultList
 
@@ -51,12 +58,16 @@ def get_result_message(r: Result, start: Optional[str] = "") -> str:
       t += __get_endpoint_message(m)
     elif isinstance(m.get_message(), PortMessageContent):
       t += __get_port_message(m)
+    elif isinstance(m.get_message(), PskMessageContent):
+      t += __get_psk_message(m)
     elif isinstance(m.get_message(), AAIPsMessageContent):
       t += __get_aaips_message(m)
     elif isinstance(m.get_message(), KeyPresenceMessageContent):
       t += __get_key_presence_message(m)
     elif isinstance(m.get_message(), KeyDatatypeMessageContent):
       t += __get_key_datatype_message(m)
+    elif isinstance(m.get_message(), KeyIndexMessageContent):
+      t += __get_key_index_message(m)
     elif isinstance(m.get_message(), ConnectionTableMessageContent):
       t += __get_connection_table_message(m)
     if t == start:
@@ -107,6 +118,11 @@ def __get_ip_network_message(msg: IPNetworkMessage) -> str:
     s += f"{strings['integrity']['ip_network_prefix']}\n".format(
       msg.get_message().ip_network,
       msg.get_message().prefix)
+  elif msg.get_message(
+  ).message_type == IP_NETWORK_MESSAGE_TYPE.NETWORK_EXHAUSTED:
+    s += __get_message_level(msg)
+    s += f"{strings['integrity']['ip_network_exhausted']}\n".format(
+      msg.get_message().ip_network)
   return s
 
 
@@ -119,6 +135,18 @@ def __get_endpoint_message(msg: EndpointMessage) -> str:
   return s
 
 
+def __get_psk_message(msg: PskMessage) -> str:
+  s = ""
+  if msg.get_message().message_type == PSK_MESSAGE_TYPE.PSK_MODE_INVALID:
+    s += __get_message_level(msg)
+    s += f"{strings['integrity']['psk_mode_invalid']}\n".format(
+      msg.get_message().psk_mode, ", ".join(PSK_MODES))
+  elif msg.get_message().message_type == PSK_MESSAGE_TYPE.PSK_SECRET_INVALID:
+    s += __get_message_level(msg)
+    s += f"{strings['integrity']['psk_secret_invalid']}\n"
+  return s
+
+
 def __get_port_message(msg: PortMessage) -> str:
   s = ""
   if msg.get_message().message_type == PORT_MESSAGE_TYPE.PORT_INVALID:
@@ -166,6 +194,21 @@ def __get_key_datatype_message(msg: KeyDatatypeMessage) -> str:
   return s
 
 
+def __get_key_index_message(msg: KeyIndexMessage) -> str:
+  s = ""
+  if msg.get_message().message_type == KEY_INDEX_MESSAGE_TYPE.KEY_MALFORMED:
+    s += __get_message_level(msg)
+    s += f"{strings['integrity']['key_index_malformed']}\n".format(
+      msg.get_message().key)
+  elif msg.get_message().message_type == KEY_INDEX_MESSAGE_TYPE.KEY_DUPLICATE:
+    s += __get_message_level(msg)
+    s += f"{strings['integrity']['key_index_duplicate']}\n".format(
+      msg.get_message().key,
+      msg.get_message().peer,
+      msg.get_message().site)
+  return s
+
+
 def __get_message_level(msg: Message) -> str:
   s = ""
   if msg.get_message_level() == MESSAGE_LEVEL.ERROR:
@@ -36,12 +36,35 @@ from ..shared import strings
 
 
 def create_wireguard_config(w: WireUI, site_name: str):
-  created_files = w.create_wireguard_config(site_name)
+  result = w.create_wireguard_config(site_name)
   print_message(1, f"{strings['shared_actions']['create_wg_cfg_list_files']}")
-  print_list(created_files)
+  print_list(result.written)
   print_message(
     0, f"{strings['shared_actions']['create_wg_cfg_files_created']}".format(
-      len(created_files)))
+      len(result.written), len(result.unchanged), len(result.removed)))
+  if result.saved_prefixes:
+    print_message(
+      0, f"{strings['shared_actions']['create_wg_cfg_prefixes_saved']}".format(
+        sum(result.saved_prefixes.values()), len(result.saved_prefixes)))
+
+
+def create_all_wireguard_configs(w: WireUI):
+  results = w.create_all_wireguard_configs()
+  failed = 0
+  for site_name, r in results.items():
+    if r.error is not None:
+      failed += 1
+      print_error(
+        0, f"{strings['shared_actions']['create_wg_cfg_site_failed']}".format(
+          site_name, r.error))
+    else:
+      print_message(
+        0, f"{strings['shared_actions']['create_wg_cfg_site_result']}".format(
+          site_name, len(r.result.written), len(r.result.unchanged),
+          len(r.result.removed), r.seconds))
+  print_message(
+    0, f"{strings['shared_actions']['create_wg_cfg_sites_done']}".format(
+      len(results) - failed, failed))
 
 
 def edit_peer_connections(w: WireUI, site_name: str):
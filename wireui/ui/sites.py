@@ -102,8 +102,7 @@ def edit_site():
   # Get DNS
   dns = __get_dns(w, allow_ipv4, allow_ipv6, s.dns)
 
-  w.set_site(
-    Site(name=site_name, ip_networks=ip_networks, dns=dns, peers=s.peers))
+  w.set_site(s._replace(ip_networks=ip_networks, dns=dns))
 
   if yes_no_menu(
       f"{strings['site_actions']['edit_site_connection_table_yes_no']}",